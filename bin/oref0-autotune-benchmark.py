@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# Reproducible benchmark for oref0-autotune.py.
+#
+# Generates synthetic CGM entries, treatments and a pump profile for a number
+# of days, serves them from a local stand-in for Nightscout's
+# /api/v1/entries/sgv.json and /api/v1/treatments.json (with an injectable
+# per-request latency), runs the autotune pipeline against it and reports the
+# wall time of each stage (download, prep, core, export, report) per scenario.
+#
+# Run it from an oref0 checkout with the Node dependencies installed
+# (npm install); the oref0-autotune-* commands are taken from this checkout's
+# bin directory, so oref0 does not need to be installed globally:
+#
+#   python bin/oref0-autotune-benchmark.py                      # 7, 30 and 90 days
+#   python bin/oref0-autotune-benchmark.py --days 30 --latency 0.2 --worker
+#   python bin/oref0-autotune-benchmark.py --json results.json  # for comparing commits
+#
+# The data is generated from a fixed seed, so two runs with the same options
+# download and tune exactly the same data.
+
+from __future__ import print_function
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+BIN_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(BIN_DIR)
+START_DATE = datetime.datetime(2020, 1, 6)
+STAGES = ('download', 'prep', 'core', 'export', 'report')
+
+
+def load_autotune():
+    # oref0-autotune.py has a dash in its name, so load it from its path
+    path = os.path.join(BIN_DIR, 'oref0-autotune.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('oref0_autotune', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except ImportError:
+        import imp
+        return imp.load_source('oref0_autotune', path)
+
+
+def iso(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def parse_iso(value):
+    # the UTC ISO forms oref0-autotune.py sends and the stand-in stores
+    value = value.rstrip('Z').split('.')[0]
+    return (datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S') - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def generate(days, seed=1):
+    """Synthetic (entries, treatments) covering days plus the lookback/lookahead autotune downloads.
+
+    BG follows a daily curve with a rise after each of three meals and some
+    noise; treatments are the carbs and boluses for those meals and a temp
+    basal every 30 minutes, shaped like Nightscout's records.
+    """
+    rng = random.Random(seed)
+    first = int(time.mktime((START_DATE - datetime.timedelta(days=2)).timetuple()))
+    last = int(time.mktime((START_DATE + datetime.timedelta(days=days + 2)).timetuple()))
+    meals = []
+    for day in range(first, last, 86400):
+        for hour, carbs in ((7.5, 40), (12.5, 60), (18.5, 70)):
+            meals.append((day + int(hour * 3600) + rng.randint(-1800, 1800), carbs + rng.randint(-15, 15)))
+
+    entries = []
+    meal_index = 0
+    for t in range(first, last, 300):
+        while meal_index + 1 < len(meals) and meals[meal_index + 1][0] <= t:
+            meal_index += 1
+        since_meal, carbs = t - meals[meal_index][0], meals[meal_index][1]
+        rise = carbs * 1.5 * math.exp(-((since_meal - 3600) / 2400.0) ** 2) if since_meal >= 0 else 0
+        dawn = 20 * math.sin((t % 86400) / 86400.0 * 2 * math.pi)
+        sgv = int(max(40, min(400, 110 + dawn + rise + rng.gauss(0, 6))))
+        entries.append({'_id': 'e{0}'.format(t), 'type': 'sgv', 'sgv': sgv, 'date': t * 1000,
+                        'dateString': iso(t), 'device': 'benchmark', 'direction': 'Flat'})
+
+    treatments = []
+    for n, (t, carbs) in enumerate(meals):
+        treatments.append({'_id': 'm{0}'.format(n), 'eventType': 'Meal Bolus', 'created_at': iso(t),
+                           'carbs': carbs, 'insulin': round(carbs / 10.0, 1), 'enteredBy': 'benchmark'})
+    for t in range(first, last, 1800):
+        rate = round(max(0, 1.0 + rng.gauss(0, 0.4)), 2)
+        treatments.append({'_id': 'b{0}'.format(t), 'eventType': 'Temp Basal', 'created_at': iso(t),
+                           'duration': 30, 'rate': rate, 'absolute': rate, 'enteredBy': 'benchmark'})
+    return entries, treatments
+
+
+class StandInNightscout(ThreadingMixIn, HTTPServer):
+    """The two Nightscout endpoints oref0-autotune.py uses, over synthetic data.
+
+    Both return records newest first, honour the find[...] bounds and count
+    oref0-autotune.py sends, and sleep latency seconds before answering.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, entries, treatments, latency=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.requests_served = 0
+        self.entries = sorted(entries, key=lambda e: e['date'])
+        self.entry_times = [e['date'] for e in self.entries]
+        self.treatments = sorted(treatments, key=lambda t: t['created_at'])
+        self.treatment_times = [parse_iso(t['created_at']) for t in self.treatments]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def query(self, records, times, query, field, parse):
+        lo = bisect.bisect_left(times, parse(query['find[{0}][$gte]'.format(field)][0])) \
+            if 'find[{0}][$gte]'.format(field) in query else 0
+        hi = len(records)
+        if 'find[{0}][$lte]'.format(field) in query:
+            hi = bisect.bisect_right(times, parse(query['find[{0}][$lte]'.format(field)][0]))
+        elif 'find[{0}][$lt]'.format(field) in query:
+            hi = bisect.bisect_left(times, parse(query['find[{0}][$lt]'.format(field)][0]))
+        count = int(query.get('count', ['10'])[0])
+        return records[max(lo, hi - count):hi][::-1]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        time.sleep(server.latency)
+        server.requests_served += 1
+        if url.path == '/api/v1/entries/sgv.json':
+            body = server.query(server.entries, server.entry_times, query, 'date', float)
+        elif url.path == '/api/v1/treatments.json':
+            body = server.query(server.treatments, server.treatment_times, query, 'created_at', parse_iso)
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def command_directory(directory):
+    # the commands of package.json as npm would install them, pointing into this checkout
+    os.makedirs(directory)
+    with open(os.path.join(ROOT_DIR, 'package.json')) as f:
+        commands = json.load(f)['bin']
+    for command, path in commands.items():
+        os.symlink(os.path.join(ROOT_DIR, path), os.path.join(directory, command))
+    return directory
+
+
+def timed(timings, stage, function, *args):
+    started = time.time()
+    try:
+        function(*args)
+    except Exception:
+        logging.exception('{0} failed'.format(stage))
+        timings[stage + '_failed'] = True
+    timings[stage] = time.time() - started
+
+
+def run_scenario(autotune, days, options, work_directory):
+    entries, treatments = generate(days)
+    server = StandInNightscout(entries, treatments, options.latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    directory = os.path.join(work_directory, '{0}days'.format(days))
+    os.makedirs(os.path.join(directory, 'settings'))
+    os.makedirs(os.path.join(directory, 'autotune'))
+    shutil.copy(os.path.join(ROOT_DIR, 'examples', 'profile.json'), os.path.join(directory, 'settings', 'pumpprofile.json'))
+
+    autotune.DIR = directory
+    autotune.NIGHTSCOUT_HOST = server.url
+    autotune.CONCURRENCY = options.concurrency
+    autotune.CACHE_DIR = os.path.join(directory, 'cache') if options.cache else None
+    autotune.WORKER = options.worker
+    autotune._nightscout_session = None
+    start_date = START_DATE
+    end_date = START_DATE + datetime.timedelta(days=days)
+
+    timings = {'days': days, 'entries': len(entries), 'treatments': len(treatments)}
+    started = time.time()
+    autotune.get_openaps_profile(directory)
+    timed(timings, 'download', lambda: (
+        autotune.get_nightscout_carb_and_insulin_treatments(server.url, start_date, end_date, directory),
+        autotune.get_nightscout_bg_entries(server.url, start_date, end_date, directory)))
+    timings['requests'] = server.requests_served
+    profiles = []
+    timed(timings, 'tune', autotune.run_autotune, start_date, end_date, options.runs, directory, None, profiles)
+    timings['prep'] = autotune.STEP_SECONDS['prep']
+    timings['core'] = autotune.STEP_SECONDS['core']
+    timed(timings, 'export', autotune.export_to_excel, directory, 'autotune.xlsx', profiles)
+    timed(timings, 'report', autotune.create_summary_report_and_display_results, directory)
+    # the commands' exit codes are not checked by oref0-autotune.py, so check their outputs
+    try:
+        with open(os.path.join(directory, 'autotune', 'profile.json')) as f:
+            json.load(f)
+    except ValueError:
+        timings['tune_failed'] = True
+    if not os.path.exists(os.path.join(directory, 'autotune.xlsx')):
+        timings['export_failed'] = True
+    if not os.path.exists(os.path.join(directory, 'autotune', 'autotune_recommendations.log')):
+        timings['report_failed'] = True
+    timings['total'] = time.time() - started
+
+    server.shutdown()
+    server.server_close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark oref0-autotune.py against synthetic data')
+    parser.add_argument('--days', default='7,30,90', help='comma separated scenarios, default 7,30,90')
+    parser.add_argument('--runs', type=int, default=1, help='autotune runs per scenario, default 1')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per Nightscout request, default 0.05')
+    parser.add_argument('--concurrency', '-c', type=int, default=4, help='parallel Nightscout downloads, default 4')
+    parser.add_argument('--worker', action='store_true', help='run prep and core in oref0-autotune-worker')
+    parser.add_argument('--cache', action='store_true', help='use the Nightscout and step caches (cold on each scenario)')
+    parser.add_argument('--keep', help='keep the generated directories here instead of a temporary directory')
+    parser.add_argument('--json', help='also write the timings to this file')
+    parser.add_argument('--verbose', '-v', action='store_true', help='show autotune logging')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.ERROR)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+    work_directory = options.keep or tempfile.mkdtemp(prefix='oref0-autotune-benchmark-')
+    os.environ['PATH'] = command_directory(os.path.join(work_directory, 'bin')) + os.pathsep + os.environ['PATH']
+    autotune = load_autotune()
+
+    results = []
+    try:
+        for days in [int(d) for d in options.days.split(',')]:
+            results.append(run_scenario(autotune, days, options, work_directory))
+    finally:
+        if not options.keep:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    print()
+    print("%6s %9s %9s %9s %9s %9s %9s %9s" % (('days', 'requests') + STAGES + ('total',)))
+    for timings in results:
+        cells = ['%8.2fs' % timings[stage] + ('!' if timings.get(stage + '_failed') else ' ') for stage in STAGES]
+        if timings.get('tune_failed'):
+            cells[1:3] = [cell[:-1] + '!' for cell in cells[1:3]]
+        print("%6d %9d %s %8.2fs" % (timings['days'], timings['requests'], ' '.join(cells), timings['total']))
+    if any(timings.get(stage + '_failed') for timings in results for stage in STAGES + ('tune',)):
+        print("! stage failed, see the log above; its time is not comparable")
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'options': vars(options), 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,16 +23,9 @@
 var autotune = require('../lib/autotune');
 var stringify = require('json-stable-stringify');
 
-if (!module.parent) {
-    var argv = require('yargs')
-        .usage("$0 <autotune/glucose.json> <autotune/autotune.json> <settings/profile.json>")
-        .demand(3)
-        .strict(true)
-        .help('help');
-
-    var params = argv.argv;
-    var inputs = params._;
-
+// Tune from the given input files; returns what the command line tool prints.
+// Also called in-process by oref0-autotune-worker.
+function autotuneCore (inputs) {
     var prepped_glucose_input = inputs[0];
     var previous_autotune_input = inputs[1];
     var pumpprofile_input = inputs[2];
@@ -43,8 +36,8 @@ if (!module.parent) {
         var previous_autotune_data = JSON.parse(fs.readFileSync(previous_autotune_input, 'utf8'));
         var pumpprofile_data = JSON.parse(fs.readFileSync(pumpprofile_input, 'utf8'));
     } catch (e) {
-        console.log('{ "error": "Could not parse input data" }');
-        return console.error("Could not parse input data: ", e);
+        console.error("Could not parse input data: ", e);
+        return '{ "error": "Could not parse input data" }';
     }
 
     // Pump profile has an up to date copy of useCustomPeakTime from preferences
@@ -65,6 +58,19 @@ if (!module.parent) {
     };
 
     var autotune_output = autotune(inputs);
-    console.log(stringify(autotune_output, { space: '   '}));
+    return stringify(autotune_output, { space: '   '});
+}
+
+if (!module.parent) {
+    var argv = require('yargs')
+        .usage("$0 <autotune/glucose.json> <autotune/autotune.json> <settings/profile.json>")
+        .demand(3)
+        .strict(true)
+        .help('help');
+
+    var params = argv.argv;
+
+    console.log(autotuneCore(params._));
 }
 
+module.exports = autotuneCore;
@@ -23,54 +23,29 @@
 var generate = require('../lib/autotune-prep');
 var _ = require('lodash');
 var moment = require('moment');
+var readFile = require('../lib/require-utils').readFileMaybeGzipped;
 
-if (!module.parent) {
-
-    var argv = require('yargs')
-        .usage("$0 <pumphistory.json> <profile.json> <glucose.json> <pumpprofile.json> [<carbhistory.json>] [--categorize_uam_as_basal] [--tune-insulin-curve]")
-        .option('categorize_uam_as_basal', {
-            alias: 'u',
-            boolean: true,
-            describe: "Categorize UAM as basal",
-            default: false
-        })
-        .option('tune-insulin-curve', {
-            alias: 'i',
-            boolean: true,
-            describe: "Tune peak time and end time",
-            default: false
-        })
-        .strict(true)
-        .help('help');
-
-    var params = argv.argv;
-    var inputs = params._;
-
-    if (inputs.length < 4 || inputs.length > 5) {
-        argv.showHelp();
-        console.log('{ "error": "Insufficient arguments" }');
-        process.exit(1);
-    }
-
+// Prep the given input files; returns what the command line tool prints.
+// Also called in-process by oref0-autotune-worker.
+function autotunePrep (inputs, params) {
     var pumphistory_input = inputs[0];
     var profile_input = inputs[1];
     var glucose_input = inputs[2];
     var pumpprofile_input = inputs[3];
     var carb_input = inputs[4];
 
-    var fs = require('fs');
     try {
-        var pumphistory_data = JSON.parse(fs.readFileSync(pumphistory_input, 'utf8'));
-        var profile_data = JSON.parse(fs.readFileSync(profile_input, 'utf8'));
+        var pumphistory_data = JSON.parse(readFile(pumphistory_input));
+        var profile_data = JSON.parse(readFile(profile_input));
     } catch (e) {
-        console.log('{ "error": "Could not parse input data" }');
-        return console.error("Could not parse input data: ", e);
+        console.error("Could not parse input data: ", e);
+        return '{ "error": "Could not parse input data" }';
     }
 
     var pumpprofile_data = { };
     if (typeof pumpprofile_input !== 'undefined') {
         try {
-            pumpprofile_data = JSON.parse(fs.readFileSync(pumpprofile_input, 'utf8'));
+            pumpprofile_data = JSON.parse(readFile(pumpprofile_input));
         } catch (e) {
             console.error("Warning: could not parse "+pumpprofile_input);
         }
@@ -79,8 +54,8 @@ if (!module.parent) {
     // disallow impossibly low carbRatios due to bad decoding
     if ( typeof(profile_data.carb_ratio) === 'undefined' || profile_data.carb_ratio < 2 ) {
         if ( typeof(pumpprofile_data.carb_ratio) === 'undefined' || pumpprofile_data.carb_ratio < 2 ) {
-            console.log('{ "carbs": 0, "mealCOB": 0, "reason": "carb_ratios ' + profile_data.carb_ratio + ' and ' + pumpprofile_data.carb_ratio + ' out of bounds" }');
-            return console.error("Error: carb_ratios " + profile_data.carb_ratio + ' and ' + pumpprofile_data.carb_ratio + " out of bounds");
+            console.error("Error: carb_ratios " + profile_data.carb_ratio + ' and ' + pumpprofile_data.carb_ratio + " out of bounds");
+            return '{ "carbs": 0, "mealCOB": 0, "reason": "carb_ratios ' + profile_data.carb_ratio + ' and ' + pumpprofile_data.carb_ratio + ' out of bounds" }';
         } else {
             profile_data.carb_ratio = pumpprofile_data.carb_ratio;
         }
@@ -101,7 +76,7 @@ if (!module.parent) {
     profile_data.curve = pumpprofile_data.curve;
 
     try {
-        var glucose_data = JSON.parse(fs.readFileSync(glucose_input, 'utf8'));
+        var glucose_data = JSON.parse(readFile(glucose_input));
     } catch (e) {
         console.error("Warning: could not parse "+glucose_input);
     }
@@ -109,7 +84,7 @@ if (!module.parent) {
     var carb_data = { };
     if (typeof carb_input !== 'undefined') {
         try {
-            carb_data = JSON.parse(fs.readFileSync(carb_input, 'utf8'));
+            carb_data = JSON.parse(readFile(carb_input));
         } catch (e) {
             console.error("Warning: could not parse "+carb_input);
         }
@@ -129,6 +104,38 @@ if (!module.parent) {
     };
 
     var prepped_glucose = generate(inputs);
-    console.log(JSON.stringify(prepped_glucose));
+    return JSON.stringify(prepped_glucose);
+}
+
+if (!module.parent) {
+
+    var argv = require('yargs')
+        .usage("$0 <pumphistory.json> <profile.json> <glucose.json> <pumpprofile.json> [<carbhistory.json>] [--categorize_uam_as_basal] [--tune-insulin-curve]")
+        .option('categorize_uam_as_basal', {
+            alias: 'u',
+            boolean: true,
+            describe: "Categorize UAM as basal",
+            default: false
+        })
+        .option('tune-insulin-curve', {
+            alias: 'i',
+            boolean: true,
+            describe: "Tune peak time and end time",
+            default: false
+        })
+        .strict(true)
+        .help('help');
+
+    var params = argv.argv;
+    var inputs = params._;
+
+    if (inputs.length < 4 || inputs.length > 5) {
+        argv.showHelp();
+        console.log('{ "error": "Insufficient arguments" }');
+        process.exit(1);
+    }
+
+    console.log(autotunePrep(inputs, params));
 }
 
+module.exports = autotunePrep;
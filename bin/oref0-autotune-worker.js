@@ -0,0 +1,74 @@
+#!/usr/bin/env node
+
+/*
+  oref0 autotune worker
+
+  Long-lived process that runs oref0-autotune-prep and oref0-autotune-core
+  jobs in-process, so a multi-day, multi-run autotune starts Node once
+  instead of twice per day per run.
+
+  Reads one JSON job per line on stdin:
+
+    {"command": "prep", "args": [<pumphistory.json>, <profile.json>, <glucose.json>, <pumpprofile.json>],
+     "options": {"categorize_uam_as_basal": false, "tune-insulin-curve": false}, "output": <file>}
+    {"command": "core", "args": [<autotune/glucose.json>, <autotune/autotune.json>, <settings/profile.json>],
+     "output": <file>}
+
+  writes to "output" exactly what the command line tool would print, and
+  answers each job with one line on stdout: {"ok": true} or
+  {"ok": false, "error": "..."}.
+
+  Released under MIT license. See the accompanying LICENSE.txt file for
+  full terms and conditions
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+  THE SOFTWARE.
+
+*/
+
+var fs = require('fs');
+var readline = require('readline');
+
+var commands = {
+    prep: require('./oref0-autotune-prep')
+  , core: require('./oref0-autotune-core')
+};
+
+function runJob (job) {
+    // like `oref0-autotune-<command> ... > output`: a job that fails leaves the output empty
+    // rather than whatever an earlier job wrote there
+    fs.writeFileSync(job.output, '');
+    var command = commands[job.command];
+    if (!command) {
+        throw new Error('unknown command ' + job.command);
+    }
+    var output = command(job.args, job.options || { });
+    fs.writeFileSync(job.output, output + '\n');
+}
+
+if (!module.parent) {
+    // stdout carries the replies, so anything the jobs log goes to stderr
+    var reply = process.stdout.write.bind(process.stdout);
+    console.log = console.error;
+
+    var rl = readline.createInterface({ input: process.stdin, terminal: false });
+    rl.on('line', function (line) {
+        if (!line.trim()) {
+            return;
+        }
+        try {
+            runJob(JSON.parse(line));
+            reply(JSON.stringify({ ok: true }) + '\n');
+        } catch (e) {
+            console.error(e);
+            reply(JSON.stringify({ ok: false, error: String(e && e.message || e) }) + '\n');
+        }
+    });
+}
+
+module.exports = runJob;
@@ -15,18 +15,85 @@ from __future__ import print_function
 #   NUMBER_OF_RUNS (--runs=<integer, number of runs desired>)
 #     if no number of runs designated, then default to 5
 #   EXPORT_EXCEL (--xlsx=<filenameofexcel>)
-#     export to excel. Disabled by default
+#     export to excel, relative to DIR. Disabled by default. The export runs in-process
+#     (oref0_autotune_export_to_xlsx.py) on the profiles tuned, without reading them back from disk
 #   TERMINAL_LOGGING (--log <true/false(true)>
 #     logs terminal output to autotune.<date stamp>.log in the autotune directory, default to true
+#   CONCURRENCY (--concurrency=<integer>)
+#     number of Nightscout downloads to run at once over one keep-alive session, default 4
+#   CACHE_DIR (--cache-dir=<directory>)
+#     where complete days of Nightscout entries and treatments are kept between runs,
+#     default ~/.cache/oref0-autotune; --no-cache disables the cache. The outputs of prep and core
+#     steps are kept there too (under steps/), keyed by a hash of their input files and of the
+#     prep/core code (bin/oref0-autotune-{prep,core}.js and lib/), so steps whose inputs and code did
+#     not change since an earlier or interrupted run are reused instead of recomputed
+#   WARM_CACHE (--warm-cache)
+#     only download the date range into the cache and exit, e.g. from the nightly cron:
+#     oref0-autotune.py --dir=$directory --ns-host=$NIGHTSCOUT_HOST --start-date=$(date -d "30 days ago" +%F) --warm-cache
+#   COMPRESS (--compress)
+#     store ns-entries.<date>.json and ns-treatments.json gzipped (as .json.gz); oref0-autotune-prep
+#     reads them transparently. The cache is always gzipped.
+#   WORKER (--worker)
+#     run oref0-autotune-prep and oref0-autotune-core in one long-lived oref0-autotune-worker
+#     process instead of starting a shell and Node twice per day per run. Outputs are the same;
+#     the time spent in prep/core is logged at the end of each mode for comparison.
+#   SWEEP (--sweep=<configurations.json>)
+#     run autotune once per configuration, each in its own copy of the autotune and settings
+#     directories under <dir>/autotune/sweep/, and print a comparison of the tuned profiles
+#     (also written to <dir>/autotune/sweep/comparison.csv). The file holds either a list of
+#     configurations or a grid whose values are lists, e.g.
+#       {"start_date": ["2020-01-01", "2020-01-15"], "end_date": "2020-02-01", "runs": [1, 3, 5]}
+#     keys not given default to the command line values. Nightscout is downloaded once for the
+#     whole range. SWEEP_JOBS (--sweep-jobs=<integer>) configurations run at once, default one
+#     per CPU core.
+#   BY_WEEKDAY (--by-weekday)
+#     download the date range once, split its days by weekday and tune the seven weekdays
+#     concurrently (SWEEP_JOBS at once), each in <dir>/autotune/weekday/day<N>/ with N as in
+#     `date +%u` (1 is Monday). Each weekday starts from autotune/profile-day<N>.json if it exists
+#     and its tuned profile is written back there, where oref0-autotune-dayofweek.sh picks it up.
+#     The seven profiles are compared in one table, also written to autotune/weekday/comparison.csv
+#   CONVERGE (--converge=<tolerance>)
+#     stop before NUMBER_OF_RUNS once a run changes no 30-minute basal slot, ISF slot or the carb
+#     ratio by more than this fraction of its previous value (e.g. 0.01 for 1%); each run's largest
+#     changes are logged
+#   RUN_STORE (--run-store)
+#     keep the per run and day profile, autotune and newprofile outputs in one SQLite database,
+#     autotune/runs.sqlite, instead of three files per run and day; the Excel export reads it from
+#     there. Query it with e.g. sqlite3 autotune/runs.sqlite "select output from steps where
+#     run=1 and date='2020-01-01' and kind='newprofile'"
+#   TRACE (--trace=<trace.json>)
+#     record every download, prep/core step, file copy, export and report with its start, duration,
+#     bytes in/out and exit status in Chrome trace-event format (open it in chrome://tracing or
+#     https://ui.perfetto.dev), and print the slowest of them at the end of the run
 
 
 import argparse
+import atexit
 import requests
 import datetime
 import os, errno
+import bisect
+import calendar
+import contextlib
+import gzip
+import hashlib
+import itertools
+import json
 import logging
-from subprocess import call
+import multiprocessing
+import re
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from subprocess import call, Popen, PIPE
 import shutil
+import sqlite3
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
 
 
 DIR = ''
@@ -37,6 +104,44 @@ NUMBER_OF_RUNS = 1
 EXPORT_EXCEL = None
 TERMINAL_LOGGING = True
 RECOMMENDS_REPORT = True
+CONCURRENCY = 4
+CACHE_DIR = os.path.expanduser(os.path.join('~', '.cache', 'oref0-autotune'))
+WARM_CACHE = False
+COMPRESS = False
+WORKER = False
+SWEEP = None
+SWEEP_JOBS = multiprocessing.cpu_count()
+BY_WEEKDAY = False
+CONVERGE = None
+RUN_STORE = False
+TRACE = None
+
+# (connect, read) timeouts in seconds for Nightscout requests
+NIGHTSCOUT_TIMEOUT = (10, 120)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# treatments are fetched in windows of at most this many days, each paged
+# through this many records per request
+TREATMENTS_WINDOW_DAYS = 7
+TREATMENTS_PAGE_SIZE = 1000
+# Nightscout compares created_at as a string against the UTC window bounds, so
+# treatments uploaded with a local offset (e.g. 2020-01-12T03:00:00-05:00) sort
+# up to that offset away from their true time; each window is queried this much
+# wider on both sides and its records filed under their parsed local day
+TREATMENTS_WINDOW_SLACK = datetime.timedelta(days=1)
+# each day's prep gets the treatments from this long before midnight to this long after,
+# as in oref0-autotune.sh: 12h either side for UTC-dated treatments, 6h of DIA lookback
+# and the 4am-4am BG window
+TREATMENTS_LOOKBACK = datetime.timedelta(hours=18)
+TREATMENTS_LOOKAHEAD = datetime.timedelta(hours=42)
+_nightscout_session = None
+_oref0_version = None
+_oref0_code_digest = None
+# wall time spent in prep and core steps, by command
+STEP_SECONDS = {'prep': 0.0, 'core': 0.0}
+_tracer = None
+
+# bump when the step cache key or output format changes
+STEP_CACHE_VERSION = 1
 
 def get_input_arguments():
     parser = argparse.ArgumentParser(description='Autotune')
@@ -79,6 +184,49 @@ def get_input_arguments():
                         type=str,
                         metavar='TERMINAL_LOGGING',
                         help='(--log <true/false(true)>)')
+    parser.add_argument('--concurrency',
+                        '-c',
+                        type=int,
+                        metavar='CONCURRENCY',
+                        help='(--concurrency=<integer, parallel Nightscout downloads (4)>)')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        metavar='CACHE_DIR',
+                        help='(--cache-dir=<directory for cached Nightscout days (~/.cache/oref0-autotune)>)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='(--no-cache, always download from Nightscout)')
+    parser.add_argument('--warm-cache',
+                        action='store_true',
+                        help='(--warm-cache, only download the date range into the cache)')
+    parser.add_argument('--compress',
+                        action='store_true',
+                        help='(--compress, store Nightscout downloads in the autotune directory gzipped)')
+    parser.add_argument('--worker',
+                        action='store_true',
+                        help='(--worker, run prep and core in one persistent Node process)')
+    parser.add_argument('--sweep',
+                        type=str,
+                        metavar='SWEEP',
+                        help='(--sweep=<JSON file of configurations to run and compare>)')
+    parser.add_argument('--sweep-jobs',
+                        type=int,
+                        metavar='SWEEP_JOBS',
+                        help='(--sweep-jobs=<integer, configurations to run at once (CPU cores)>)')
+    parser.add_argument('--by-weekday',
+                        action='store_true',
+                        help='(--by-weekday, tune one profile per day of the week, concurrently)')
+    parser.add_argument('--converge',
+                        type=float,
+                        metavar='CONVERGE',
+                        help='(--converge=<fraction, stop once no basal/ISF/CR value changes more between runs>)')
+    parser.add_argument('--run-store',
+                        action='store_true',
+                        help='(--run-store, keep per run and day outputs in autotune/runs.sqlite)')
+    parser.add_argument('--trace',
+                        type=str,
+                        metavar='TRACE',
+                        help='(--trace=<file to write a Chrome trace-event timeline of the run to>)')
     
     return parser.parse_args()
 
@@ -86,7 +234,8 @@ def assign_args_to_variables(args):
     # TODO: Input checking.
     
     global DIR, NIGHTSCOUT_HOST, START_DATE, END_DATE, NUMBER_OF_RUNS, \
-           EXPORT_EXCEL, TERMINAL_LOGGING, RECOMMENDS_REPORT
+           EXPORT_EXCEL, TERMINAL_LOGGING, RECOMMENDS_REPORT, CONCURRENCY, \
+           CACHE_DIR, WARM_CACHE, COMPRESS, WORKER, SWEEP, SWEEP_JOBS, BY_WEEKDAY, CONVERGE, RUN_STORE, TRACE
     
     # On Unix and Windows, return the argument with an initial component of
     # ~ or ~user replaced by that user's home directory.
@@ -108,6 +257,221 @@ def assign_args_to_variables(args):
     if args.log is not None:
         RECOMMENDS_REPORT = args.logs
 
+    if args.concurrency is not None:
+        CONCURRENCY = max(1, args.concurrency)
+
+    if args.cache_dir is not None:
+        CACHE_DIR = os.path.expanduser(args.cache_dir)
+
+    if args.no_cache:
+        CACHE_DIR = None
+
+    WARM_CACHE = args.warm_cache
+
+    COMPRESS = args.compress
+
+    WORKER = args.worker
+
+    if args.sweep is not None:
+        SWEEP = os.path.expanduser(args.sweep)
+
+    if args.sweep_jobs is not None:
+        SWEEP_JOBS = max(1, args.sweep_jobs)
+
+    BY_WEEKDAY = args.by_weekday
+
+    if args.converge is not None:
+        CONVERGE = args.converge
+
+    RUN_STORE = args.run_store
+
+    if args.trace is not None:
+        TRACE = os.path.expanduser(args.trace)
+
+def get_nightscout_session():
+    # One session shared by all downloads so connections (and TLS handshakes)
+    # are reused; transient failures are retried with exponential backoff.
+    global _nightscout_session
+    if _nightscout_session is None:
+        retries = Retry(total=5, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY, max_retries=retries)
+        _nightscout_session = requests.Session()
+        _nightscout_session.mount('http://', adapter)
+        _nightscout_session.mount('https://', adapter)
+    return _nightscout_session
+
+def run_concurrently(function, items):
+    # map function over items on CONCURRENCY threads; the first exception is re-raised
+    pool = ThreadPool(min(CONCURRENCY, max(1, len(items))))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def to_epoch_ms(date):
+    # local naive datetime to epoch milliseconds, as `date +%s` does in oref0-autotune.sh
+    return int(time.mktime(date.timetuple())) * 1000
+
+ISO_TIMESTAMP = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?\s*(Z|[+-]\d\d:?\d\d)?$')
+
+def parse_timestamp(value):
+    # epoch seconds from a Nightscout timestamp (ISO 8601, or epoch milliseconds);
+    # timestamps without an offset are taken as UTC. Returns None if unparseable.
+    if isinstance(value, (int, float)):
+        return value / 1000.0
+    m = ISO_TIMESTAMP.match(value.strip()) if hasattr(value, 'strip') else None
+    if not m:
+        return None
+    year, month, day, hour, minute, second, offset = m.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second or 0)))
+    if offset and offset != 'Z':
+        offset = offset.replace(':', '')
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        seconds -= minutes * 60 if offset[0] == '+' else -minutes * 60
+    return seconds
+
+def is_complete_day(date):
+    # Nightscout data for a day can still arrive late (and the BG window runs
+    # to 4am the next day), so only days before yesterday are final.
+    return date + datetime.timedelta(days=2) <= datetime.datetime.now()
+
+@contextlib.contextmanager
+def atomic_data_file(path):
+    # write to a temporary file next to path and rename it into place once it is
+    # complete, so neither the cache nor autotune ever sees a partial download
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-', suffix='.gz' if path.endswith('.gz') else '')
+    os.close(fd)
+    try:
+        with open_data_file(tmp, 'wb') as f:
+            yield f
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def open_data_file(path, mode='rb'):
+    # files ending in .gz are read and written gzip-compressed
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def copy_data_file(source, destination):
+    # stream a file across, (de)compressing according to both names
+    with open_data_file(source) as s:
+        with atomic_data_file(destination) as d:
+            shutil.copyfileobj(s, d, DOWNLOAD_CHUNK_SIZE)
+
+def data_filename(name):
+    # name under which a Nightscout download is stored in the autotune directory
+    return name + '.gz' if COMPRESS else name
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class Tracer(object):
+    """Timeline of the run in Chrome trace-event format.
+
+    Every traced operation becomes one complete ("X") event with its start,
+    duration, process and thread; the args dict yielded by span() is stored
+    with it, so callers can fill in bytes_in, bytes_out and status as they go.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        started = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = repr(e)
+            raise
+        finally:
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+                     'tid': threading.current_thread().ident,
+                     'ts': int(started * 1e6), 'dur': int((time.time() - started) * 1e6), 'args': args}
+            with self.lock:
+                self.events.append(event)
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def print_summary(self, count=15):
+        print()
+        print("Slowest steps ({0} traced, timeline in {1}):".format(len(self.events), TRACE))
+        print("---------------------------------------------------------")
+        print("{0:>9}  {1:<9} {2:>10} {3:>10} {4:>6}  {5}".format('seconds', 'category', 'bytes in', 'bytes out', 'status', 'step'))
+        for event in sorted(self.events, key=lambda e: e['dur'], reverse=True)[:count]:
+            args = event['args']
+            print("{0:>9.3f}  {1:<9} {2:>10} {3:>10} {4:>6}  {5}".format(
+                event['dur'] / 1e6, event['cat'], args.get('bytes_in', ''), args.get('bytes_out', ''),
+                'error' if 'error' in args else args.get('status', ''), event['name']))
+
+@contextlib.contextmanager
+def _untraced(args):
+    yield args
+
+def trace(name, category, **args):
+    # context manager timing one operation when --trace is on; yields a dict for its details
+    return _tracer.span(name, category, **args) if _tracer else _untraced(args)
+
+def start_trace():
+    global _tracer
+    _tracer = Tracer()
+    atexit.register(finish_trace)
+
+def finish_trace():
+    _tracer.write(TRACE)
+    _tracer.print_summary()
+
+def copy_file(source, destination):
+    with trace('copy {0}'.format(os.path.basename(destination)), 'copy', source=source) as details:
+        shutil.copy(source, destination)
+        details['bytes_in'] = details['bytes_out'] = file_size(destination)
+
+class NightscoutCache(object):
+    """Complete days of Nightscout downloads, kept between runs.
+
+    Files live gzip-compressed under
+    <cache_dir>/<nightscout host>/<kind>/<YYYY-MM-DD>.json.gz and are only
+    written (atomically) once is_complete_day() says the day can no longer
+    change, so a day's file existing is the record that it never has to be
+    fetched again.
+    """
+
+    def __init__(self, cache_dir, nightscout_host):
+        host = re.sub(r'^[a-z]+://', '', nightscout_host.rstrip('/'))
+        self.directory = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9.-]+', '_', host))
+
+    def path(self, kind, date):
+        return os.path.join(self.directory, kind, '{date}.json.gz'.format(date=date.strftime("%Y-%m-%d")))
+
+    def get(self, kind, date):
+        path = self.path(kind, date)
+        return path if os.path.exists(path) else None
+
+    def writer(self, kind, date):
+        # context manager for writing a complete day, or None if the day may still change
+        if not is_complete_day(date):
+            return None
+        path = self.path(kind, date)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return atomic_data_file(path)
+
+def get_nightscout_cache(nightscout_host):
+    return NightscoutCache(CACHE_DIR, nightscout_host) if CACHE_DIR else None
+
 def get_nightscout_profile(nightscout_host):
     #TODO: Add ability to use API secret for Nightscout.
     res = requests.get(nightscout_host + '/api/v1/profile.json')
@@ -115,13 +479,13 @@ def get_nightscout_profile(nightscout_host):
         f.write(res.text)
 
 def get_openaps_profile(directory):
-    shutil.copy(os.path.join(directory, 'settings', 'pumpprofile.json'), os.path.join(directory, 'autotune', 'profile.pump.json'))
+    copy_file(os.path.join(directory, 'settings', 'pumpprofile.json'), os.path.join(directory, 'autotune', 'profile.pump.json'))
     
     # If a previous valid settings/autotune.json exists, use that; otherwise start from settings/profile.json
     
     # This allows manual users to be able to run autotune by simply creating a settings/pumpprofile.json file.
     # cp -up settings/pumpprofile.json settings/profile.json
-    shutil.copy(os.path.join(directory, 'settings', 'pumpprofile.json'), os.path.join(directory, 'settings', 'profile.json'))
+    copy_file(os.path.join(directory, 'settings', 'pumpprofile.json'), os.path.join(directory, 'settings', 'profile.json'))
     
     # TODO: Get this to work. For now, just copy from settings/profile.json each time.
     # If a previous valid settings/autotune.json exists, use that; otherwise start from settings/profile.json
@@ -131,88 +495,743 @@ def get_openaps_profile(directory):
     # call(create_autotune_json, shell=True)
 
     # cp settings/autotune.json autotune/profile.json
-    shutil.copy(os.path.join(directory, 'settings', 'profile.json'), os.path.join(directory, 'settings', 'autotune.json'))
+    copy_file(os.path.join(directory, 'settings', 'profile.json'), os.path.join(directory, 'settings', 'autotune.json'))
     
     # cp settings/autotune.json autotune/profile.json
-    shutil.copy(os.path.join(directory, 'settings', 'autotune.json'), os.path.join(directory, 'autotune', 'profile.json'))
+    copy_file(os.path.join(directory, 'settings', 'autotune.json'), os.path.join(directory, 'autotune', 'profile.json'))
     
     #TODO: Do the correct copying here.
     # cat autotune/profile.json | json | grep -q start || cp autotune/profile.pump.json autotune/profile.json'])
 
+def get_nightscout_treatments_window(session, nightscout_host, start, end):
+    # all treatments whose created_at sorts in [start, end) as a string against the UTC bounds,
+    # de-duplicated by _id; returns (records, requests made).
+    # Nightscout returns newest first and caps every response at count, so page backwards from
+    # the oldest created_at seen until a page comes back short.
+    params = {'find[created_at][$gte]': datetime.datetime.utcfromtimestamp(time.mktime(start.timetuple())).strftime('%Y-%m-%dT%H:%M:%SZ'),
+              'find[created_at][$lt]': datetime.datetime.utcfromtimestamp(time.mktime(end.timetuple())).strftime('%Y-%m-%dT%H:%M:%SZ'),
+              'count': TREATMENTS_PAGE_SIZE}
+    records = {}
+    pages = 0
+    while True:
+        #TODO: Add ability to use API secret for Nightscout.
+        with trace('GET treatments.json {0} page {1}'.format(start.strftime("%Y-%m-%d"), pages + 1), 'download') as details:
+            res = session.get(nightscout_host + '/api/v1/treatments.json', params=params, timeout=NIGHTSCOUT_TIMEOUT)
+            details['status'] = res.status_code
+            details['bytes_in'] = len(res.content)
+            res.raise_for_status()
+            page = res.json()
+        pages += 1
+        if not isinstance(page, list):
+            raise ValueError('Unexpected treatments response from Nightscout: {0}'.format(res.text[:200]))
+        new = 0
+        for record in page:
+            key = record.get('_id') or (record.get('created_at'), json.dumps(record, sort_keys=True))
+            if key not in records:
+                records[key] = record
+                new += 1
+        if len(page) < TREATMENTS_PAGE_SIZE:
+            return list(records.values()), pages
+        if new == 0 or not page[-1].get('created_at'):
+            # a full page with nothing new: more than a page of treatments share one created_at
+            raise ValueError('Could not page through Nightscout treatments from {0} to {1} at {2}; '
+                             'the window is incomplete'.format(start, end, page[-1].get('created_at')))
+        # the next page overlaps this one at its oldest created_at; duplicates are dropped above
+        params.pop('find[created_at][$lt]', None)
+        params['find[created_at][$lte]'] = page[-1]['created_at']
+
 def get_nightscout_carb_and_insulin_treatments(nightscout_host, start_date, end_date, directory):
     logging.info('Grabbing NIGHTSCOUT treatments.json for date range: {0} to {1}'.format(start_date, end_date))
-    # TODO: What does 'T20:00-05:00' mean?
-    output_file_name = os.path.join(directory, 'autotune', 'ns-treatments.json')
-    start_date = start_date.strftime("%Y-%m-%d") + 'T20:00-05:00'
-    end_date = end_date.strftime("%Y-%m-%d") + 'T20:00-05:00'
-    url='{0}/api/v1/treatments.json?find\[created_at\]\[\$gte\]=`date --date="{1} -4 hours" -Iminutes`&find\[created_at\]\[\$lte\]=`date --date="{2} +1 days" -Iminutes`'.format(nightscout_host, start_date, end_date)
-    #TODO: Add ability to use API secret for Nightscout.
-    res = requests.get(url)
-    with open(output_file_name, 'w') as f:
-        f.write(res.text.encode('utf-8'))
+    output_file_name = os.path.join(directory, 'autotune', data_filename('ns-treatments.json'))
+    # The day before start_date covers the DIA lookback of the first day, and
+    # end_date the 4am-4am BG window of the last day plus timezone slack.
+    days = [start_date + datetime.timedelta(days=x) for x in range(-1, (end_date - start_date).days + 1)]
+    cache = get_nightscout_cache(nightscout_host)
+    session = get_nightscout_session()
+
+    # every day's treatments end up in a file of their own, either in the
+    # cache or (for days that may still change) in a scratch directory, and
+    # ns-treatments.json is streamed together from those one day at a time
+    scratch = tempfile.mkdtemp(dir=os.path.join(directory, 'autotune'), prefix='.ns-treatments-')
+    day_files = {}
+    missing = []
+    for date in days:
+        cached = cache.get('treatments', date) if cache else None
+        if cached:
+            day_files[date] = cached
+        else:
+            missing.append(date)
+    # fetch runs of consecutive missing days in windows of at most
+    # TREATMENTS_WINDOW_DAYS days, each paged through TREATMENTS_PAGE_SIZE records at a time
+    windows = []
+    for date in missing:
+        if windows and windows[-1][-1] + datetime.timedelta(days=1) == date and len(windows[-1]) < TREATMENTS_WINDOW_DAYS:
+            windows[-1].append(date)
+        else:
+            windows.append([date])
+    # key -> (created_at, record) for every missing day, filled by all windows: the slack
+    # of one window returns treatments of its neighbours, which are de-duplicated here
+    by_day = dict((date, {}) for date in missing)
+    undated = {}
+    requests_made = []
+    lock = threading.Lock()
+
+    def get_window(window):
+        start = window[0] - TREATMENTS_WINDOW_SLACK
+        end = window[-1] + datetime.timedelta(days=1) + TREATMENTS_WINDOW_SLACK
+        records, pages = get_nightscout_treatments_window(session, nightscout_host, start, end)
+        with lock:
+            requests_made.append(pages)
+            for record in records:
+                key = record.get('_id') or json.dumps(record, sort_keys=True)
+                created_at = parse_timestamp(record.get('created_at'))
+                if created_at is None:
+                    undated[key] = record
+                    continue
+                day = datetime.datetime.fromtimestamp(created_at).replace(hour=0, minute=0, second=0, microsecond=0)
+                # treatments of cached days or days outside the range are dropped
+                if day in by_day:
+                    by_day[day][key] = (created_at, record)
+
+    def write_day(date):
+        # only called once every window is in, so each day's whole range has been covered
+        # by its own window (and the slack of its neighbours) before it is cached as complete
+        writer = cache.writer('treatments', date) if cache else None
+        if writer is None:
+            day_files[date] = os.path.join(scratch, '{date}.json'.format(date=date.strftime("%Y-%m-%d")))
+            writer = atomic_data_file(day_files[date])
+        else:
+            day_files[date] = cache.path('treatments', date)
+        # newest first, like Nightscout returns them
+        records = [record for _, record in sorted(by_day[date].values(), key=lambda t: t[0], reverse=True)]
+        with writer as f:
+            f.write(json.dumps(records).encode('utf-8'))
+
+    try:
+        run_concurrently(get_window, windows)
+        for date in missing:
+            write_day(date)
+        logging.info('Treatments: {0} days from cache, {1} downloaded in {2} windows, {3} requests'.format(
+            len(days) - len(missing), len(missing), len(windows), sum(requests_made)))
+        # newest first, like Nightscout returns them
+        with trace('write {0}'.format(os.path.basename(output_file_name)), 'copy') as details:
+            with atomic_data_file(output_file_name) as out:
+                out.write(b'[')
+                separator = b''
+                for date in sorted(day_files, reverse=True):
+                    with open_data_file(day_files[date]) as f:
+                        records = json.loads(f.read().decode('utf-8'))
+                    if records:
+                        out.write(separator + json.dumps(records)[1:-1].encode('utf-8'))
+                        separator = b','
+                if undated:
+                    out.write(separator + json.dumps(list(undated.values()))[1:-1].encode('utf-8'))
+                out.write(b']')
+            details['bytes_out'] = file_size(output_file_name)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
 
 def get_nightscout_bg_entries(nightscout_host, start_date, end_date, directory):
     logging.info('Grabbing NIGHTSCOUT enries/sgv.json for date range: {0} to {1}'.format(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
     date_list = [start_date + datetime.timedelta(days=x) for x in range(0, (end_date - start_date).days)]
+    cache = get_nightscout_cache(nightscout_host)
+    session = get_nightscout_session()
 
-    for date in date_list:
-        url="{0}/api/v1/entries/sgv.json?find\[date\]\[\$gte\]={1}&find\[date\]\[\$lte\]={1}`&count=1500"
-        url = url.format(nightscout_host, date)
+    def get_day(date):
+        output_file_name = os.path.join(directory, 'autotune', data_filename('ns-entries.{date}.json'.format(date=date.strftime("%Y-%m-%d"))))
+        cached = cache.get('entries', date) if cache else None
+        if cached:
+            with trace('copy {0}'.format(os.path.basename(output_file_name)), 'copy', source=cached) as details:
+                copy_data_file(cached, output_file_name)
+                details['bytes_in'] = file_size(cached)
+                details['bytes_out'] = file_size(output_file_name)
+            return True
+        # pull CGM data from 4am-4am, as oref0-autotune.sh does
+        params = {'find[date][$gte]': to_epoch_ms(date + datetime.timedelta(hours=4)),
+                  'find[date][$lte]': to_epoch_ms(date + datetime.timedelta(hours=28)),
+                  'count': 1500}
         #TODO: Add ability to use API secret for Nightscout.
-        res = requests.get(url)
-        with open(os.path.join(directory, 'autotune', 'ns-entries.{date}.json'.format(date=date.strftime("%Y-%m-%d"))), 'w') as f:
-            f.write(res.text.encode('utf-8'))
+        # stream the (transparently gunzipped) body to disk instead of holding it in memory
+        with trace('GET sgv.json {0}'.format(date.strftime("%Y-%m-%d")), 'download') as details:
+            res = session.get(nightscout_host + '/api/v1/entries/sgv.json', params=params, timeout=NIGHTSCOUT_TIMEOUT, stream=True)
+            details['status'] = res.status_code
+            res.raise_for_status()
+            details['bytes_in'] = 0
+            with atomic_data_file(output_file_name) as f:
+                for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    details['bytes_in'] += len(chunk)
+                    f.write(chunk)
+            details['bytes_out'] = file_size(output_file_name)
+        writer = cache.writer('entries', date) if cache else None
+        if writer is not None:
+            with open_data_file(output_file_name) as source:
+                with writer as f:
+                    shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+        logging.info('Downloaded {0}'.format(os.path.basename(output_file_name)))
+        return False
 
-def run_autotune(start_date, end_date, number_of_runs, directory):
-    date_list = [start_date + datetime.timedelta(days=x) for x in range(0, (end_date - start_date).days)]
+    cached = run_concurrently(get_day, date_list)
+    logging.info('Entries: {0} days from cache, {1} downloaded'.format(sum(cached), len(cached) - sum(cached)))
+
+class AutotuneWorker(object):
+    """One oref0-autotune-worker process, fed a JSON job per line on stdin.
+
+    Each job names the command (prep or core), its input files and the file
+    to write the output to; the worker answers with one JSON line once the
+    output is written.
+    """
+
+    def __init__(self):
+        self.process = None
+
+    def run(self, command, args, output_filename, options=None):
+        if self.process is None or self.process.poll() is not None:
+            self.process = Popen(['oref0-autotune-worker'], stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        job = {'command': command, 'args': args, 'options': options or {}, 'output': output_filename}
+        self.process.stdin.write(json.dumps(job) + '\n')
+        self.process.stdin.flush()
+        reply = self.process.stdout.readline()
+        if not reply:
+            raise RuntimeError('oref0-autotune-worker exited with {0}'.format(self.process.wait()))
+        result = json.loads(reply)
+        if not result.get('ok'):
+            logging.error('oref0-autotune-{0} failed: {1}'.format(command, result.get('error')))
+        return bool(result.get('ok'))
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+class StepCache(object):
+    """Outputs of prep and core steps, keyed by a hash of everything they read.
+
+    The key covers the command, the oref0 version, the code prep and core run
+    (see get_oref0_code_digest) and the (uncompressed) contents of every input
+    file, so a step whose inputs and code are byte-identical to an earlier one
+    is answered by copying the earlier output.  Outputs are
+    stored as <cache_dir>/steps/<key[:2]>/<key>.json as soon as each step
+    finishes, which also makes an interrupted tune resumable.
+    """
+
+    def __init__(self, cache_dir):
+        self.directory = os.path.join(cache_dir, 'steps')
+        self.reused = 0
+        self.computed = 0
+
+    def key(self, command, args):
+        digest = hashlib.sha256()
+        digest.update(json.dumps([STEP_CACHE_VERSION, get_oref0_version(), get_oref0_code_digest(), command]).encode('utf-8'))
+        for filename in args:
+            digest.update(b'\0')
+            if not os.path.exists(filename):
+                digest.update(b'missing')
+                continue
+            with open_data_file(filename) as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key, output_filename):
+        # copy a cached output to output_filename; False if there is none
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+        shutil.copy(path, output_filename)
+        self.reused += 1
+        return True
+
+    def put(self, key, output_filename):
+        self.computed += 1
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(output_filename, 'rb') as source:
+            with atomic_data_file(path) as f:
+                shutil.copyfileobj(source, f, DOWNLOAD_CHUNK_SIZE)
+
+def get_step_cache():
+    return StepCache(CACHE_DIR) if CACHE_DIR else None
+
+def get_oref0_version():
+    # version from the package.json this script was installed from, '' if there is none
+    global _oref0_version
+    if _oref0_version is None:
+        _oref0_version = ''
+        package_json = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'package.json')
+        try:
+            with open(package_json) as f:
+                _oref0_version = json.load(f).get('version', '')
+        except (IOError, OSError, ValueError):
+            pass
+    return _oref0_version
+
+def get_oref0_code_digest():
+    # sha256 of the prep and core scripts and every lib/ source they can load, so editing them
+    # within the same version does not reuse cached step outputs
+    global _oref0_code_digest
+    if _oref0_code_digest is None:
+        root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+        sources = [os.path.join('bin', 'oref0-autotune-prep.js'), os.path.join('bin', 'oref0-autotune-core.js')]
+        for directory, _, filenames in os.walk(os.path.join(root, 'lib')):
+            sources.extend(os.path.relpath(os.path.join(directory, filename), root)
+                           for filename in filenames if filename.endswith('.js'))
+        digest = hashlib.sha256()
+        for source in sorted(sources):
+            digest.update(source.encode('utf-8') + b'\0')
+            try:
+                with open(os.path.join(root, source), 'rb') as f:
+                    digest.update(f.read())
+            except (IOError, OSError):
+                digest.update(b'missing')
+        _oref0_code_digest = digest.hexdigest()
+    return _oref0_code_digest
+
+def run_step(worker, step_cache, command, args, output_filename):
+    # oref0-autotune-<command> <args> > output_filename, either in the worker or in a new shell,
+    # unless step_cache already has the output for these exact inputs
+    started = time.time()
+    with trace('oref0-autotune-{0} {1}'.format(command, os.path.basename(output_filename)), command,
+               bytes_in=sum(file_size(filename) for filename in args)) as details:
+        key = step_cache.key(command, args) if step_cache else None
+        if key and step_cache.get(key, output_filename):
+            logging.info('Reused oref0-autotune-{0} output for {1}'.format(command, output_filename))
+            details['status'] = 'reused'
+        else:
+            if worker is not None:
+                logging.info('Running oref0-autotune-{0} {1} in worker'.format(command, ' '.join(args)))
+                ok = worker.run(command, args, output_filename)
+                details['status'] = 0 if ok else 1
+            else:
+                script = 'oref0-autotune-{0} {1}'.format(command, ' '.join(args))
+                with open(output_filename, "w+") as output:
+                    logging.info('Running {script}'.format(script=script))
+                    details['status'] = call(script, stdout=output, shell=True)
+                ok = details['status'] == 0
+            logging.info('Writing output to {filename}'.format(filename=output_filename))
+            if key and ok:
+                step_cache.put(key, output_filename)
+        details['bytes_out'] = file_size(output_filename)
+    STEP_SECONDS[command] += time.time() - started
+
+class RunStore(object):
+    """The profile, autotune and newprofile output of every run and day in one SQLite file.
+
+    Replaces profile.<run>.<date>.json, autotune.<run>.<date>.json and
+    newprofile.<run>.<date>.json: prep and core work on the same two files for
+    every day, whose contents are stored here keyed by (run, date, kind).
+    Each day is committed as one transaction.
+    """
+
+    FILENAME = 'runs.sqlite'
+
+    def __init__(self, autotune_directory):
+        self.path = os.path.join(autotune_directory, self.FILENAME)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS steps (run INTEGER, date TEXT, kind TEXT, output TEXT, '
+                        'PRIMARY KEY (run, date, kind))')
+        # a new tune replaces whatever an earlier one stored
+        self.db.execute('DELETE FROM steps')
+        self.db.commit()
+
+    def put(self, run_number, date, kind, filename):
+        with trace('store {0} {1} {2}'.format(kind, run_number, date.strftime("%Y-%m-%d")), 'store') as details:
+            with open(filename) as f:
+                output = f.read()
+            details['bytes_in'] = len(output)
+            self.db.execute('INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?)',
+                            (run_number, date.strftime("%Y-%m-%d"), kind, output))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def slice_treatments_by_day(autotune_directory, date_list):
+    # split ns-treatments.json once into ns-treatments.<date>.json holding only what
+    # each day's prep looks at, instead of every prep re-reading the whole range
+    with trace('slice ns-treatments.json', 'slice') as details:
+        details['bytes_in'] = file_size(os.path.join(autotune_directory, data_filename('ns-treatments.json')))
+        details['bytes_out'] = slice_treatments(autotune_directory, date_list)
+
+def slice_treatments(autotune_directory, date_list):
+    # returns the number of bytes written
+    with open_data_file(os.path.join(autotune_directory, data_filename('ns-treatments.json'))) as f:
+        treatments = json.loads(f.read().decode('utf-8'))
+    dated = []
+    undated = []
+    for record in treatments:
+        created_at = parse_timestamp(record.get('created_at'))
+        if created_at is None:
+            undated.append(record)
+        else:
+            dated.append((created_at, record))
+    dated.sort(key=lambda t: t[0])
+    times = [t for t, _ in dated]
+
+    sizes = []
+    written = 0
+    for date in date_list:
+        lo = bisect.bisect_left(times, time.mktime((date - TREATMENTS_LOOKBACK).timetuple()))
+        hi = bisect.bisect_right(times, time.mktime((date + TREATMENTS_LOOKAHEAD).timetuple()))
+        # newest first, like Nightscout returns them
+        records = [record for _, record in reversed(dated[lo:hi])] + undated
+        sizes.append(len(records))
+        filename = os.path.join(autotune_directory, data_filename('ns-treatments.{date}.json'.format(date=date.strftime("%Y-%m-%d"))))
+        with atomic_data_file(filename) as f:
+            f.write(json.dumps(records).encode('utf-8'))
+        written += file_size(filename)
+    if sizes:
+        logging.info('Sliced {0} treatments into {1} days of {2:.1f} on average'.format(
+            len(treatments), len(sizes), float(sum(sizes)) / len(sizes)))
+    return written
+
+def run_autotune(start_date, end_date, number_of_runs, directory, date_list=None, profiles=None):
+    # tunes every day from start_date up to end_date, or only the days in date_list. If profiles
+    # is a list, the profile (JSON text) each run and day starts from is added to it for export_to_excel
+    if date_list is None:
+        date_list = [start_date + datetime.timedelta(days=x) for x in range(0, (end_date - start_date).days)]
     autotune_directory = os.path.join(directory, 'autotune')
+    slice_treatments_by_day(autotune_directory, date_list)
+    worker = AutotuneWorker() if WORKER else None
+    step_cache = get_step_cache()
+    store = RunStore(autotune_directory) if RUN_STORE else None
+    for command in STEP_SECONDS:
+        STEP_SECONDS[command] = 0.0
+    started = time.time()
+    try:
+        runs_done = run_days(date_list, number_of_runs, autotune_directory, worker, step_cache, store, profiles)
+    finally:
+        if worker is not None:
+            worker.close()
+        if store is not None:
+            store.close()
+    logging.info('Ran {0} prep/core steps in {1:.1f}s ({2}): prep {3:.1f}s, core {4:.1f}s'.format(
+        2 * runs_done * len(date_list), time.time() - started, 'worker' if WORKER else 'one process per step',
+        STEP_SECONDS['prep'], STEP_SECONDS['core']))
+    if step_cache:
+        logging.info('Steps: {0} reused from {1}, {2} computed'.format(step_cache.reused, step_cache.directory, step_cache.computed))
+
+def profile_slots(entries, value_field, minutes_field):
+    # value of a basal or ISF schedule in each of the 48 half hours of the day
+    entries = sorted(entries, key=lambda e: e.get(minutes_field, 0))
+    slots = []
+    for slot in range(48):
+        value = None
+        for entry in entries:
+            if entry.get(minutes_field, 0) <= slot * 30:
+                value = entry.get(value_field)
+        slots.append(value)
+    return slots
+
+def profile_changes(old, new):
+    # largest relative change per parameter between two profiles: {name: (change, where)}
+    def relative(a, b):
+        if a is None or b is None:
+            return 0.0 if a == b else float('inf')
+        return abs(b - a) / abs(a) if a else (0.0 if a == b else float('inf'))
+
+    changes = {}
+    for name, field, value_field, minutes_field in (('basal', 'basalprofile', 'rate', 'minutes'),
+                                                    ('ISF', 'isfProfile', 'sensitivity', 'offset')):
+        old_entries = old.get(field, [])
+        new_entries = new.get(field, [])
+        if field == 'isfProfile':
+            old_entries = old_entries.get('sensitivities', []) if old_entries else []
+            new_entries = new_entries.get('sensitivities', []) if new_entries else []
+        slot_changes = [relative(a, b) for a, b in zip(profile_slots(old_entries, value_field, minutes_field),
+                                                       profile_slots(new_entries, value_field, minutes_field))]
+        slot = max(range(48), key=lambda i: slot_changes[i])
+        changes[name] = (slot_changes[slot], '{0:02d}:{1:02d}'.format(slot // 2, slot % 2 * 30))
+    changes['CR'] = (relative(old.get('carb_ratio'), new.get('carb_ratio')), '')
+    return changes
+
+def run_days(date_list, number_of_runs, autotune_directory, worker, step_cache, store, profiles=None):
+    if CONVERGE is not None:
+        with open(os.path.join(autotune_directory, 'profile.json')) as f:
+            previous_profile = json.load(f)
     for run_number in range(1, number_of_runs + 1):
         for date in date_list:
             # cp profile.json profile.$run_number.$i.json
-            shutil.copy(os.path.join(autotune_directory, 'profile.json'),
-                        os.path.join(autotune_directory, 'profile.{run_number}.{date}.json'
-                        .format(run_number=run_number, date=date.strftime("%Y-%m-%d"))))
+            if store is not None:
+                store.put(run_number, date, 'profile', os.path.join(autotune_directory, 'profile.json'))
+            else:
+                copy_file(os.path.join(autotune_directory, 'profile.json'),
+                          os.path.join(autotune_directory, 'profile.{run_number}.{date}.json'
+                          .format(run_number=run_number, date=date.strftime("%Y-%m-%d"))))
+            if profiles is not None:
+                # as text: a failed core step leaves an empty or invalid profile.json, which the
+                # exporter skips like it skips such files
+                with open(os.path.join(autotune_directory, 'profile.json')) as f:
+                    profiles.append(('autotune/profile.{run_number}.{date}.json'.format(
+                        run_number=run_number, date=date.strftime("%Y-%m-%d")), f.read()))
         
-            # Autotune Prep (required args, <pumphistory.json> <profile.json> <glucose.json>), output prepped glucose 
-            # data or <autotune/glucose.json> below
-            # oref0-autotune-prep ns-treatments.json profile.json ns-entries.$DATE.json > autotune.$RUN_NUMBER.$DATE.json
-            ns_treatments = os.path.join(autotune_directory, 'ns-treatments.json')
+            # Autotune Prep (required args, <pumphistory.json> <profile.json> <glucose.json> <pumpprofile.json>),
+            # output prepped glucose data or <autotune/glucose.json> below
+            # oref0-autotune-prep ns-treatments.$DATE.json profile.json ns-entries.$DATE.json profile.pump.json > autotune.$RUN_NUMBER.$DATE.json
+            ns_treatments = os.path.join(autotune_directory, data_filename('ns-treatments.{date}.json'.format(date=date.strftime("%Y-%m-%d"))))
             profile = os.path.join(autotune_directory, 'profile.json')
-            ns_entries = os.path.join(autotune_directory, 'ns-entries.{date}.json'.format(date=date.strftime("%Y-%m-%d")))
-            autotune_prep = 'oref0-autotune-prep {ns_treatments} {profile} {ns_entries}'.format(ns_treatments=ns_treatments, profile=profile, ns_entries=ns_entries)
+            ns_entries = os.path.join(autotune_directory, data_filename('ns-entries.{date}.json'.format(date=date.strftime("%Y-%m-%d"))))
+            profile_pump = os.path.join(autotune_directory, 'profile.pump.json')
             
-            # autotune.$RUN_NUMBER.$DATE.json  
+            # autotune.$RUN_NUMBER.$DATE.json, or the same autotune.current.json every day with the run store
             autotune_run_filename = os.path.join(autotune_directory, 'autotune.{run_number}.{date}.json'
-                                                 .format(run_number=run_number, date=date.strftime("%Y-%m-%d")))
-            with open(autotune_run_filename, "w+") as output:
-                logging.info('Running {script}'.format(script=autotune_prep))
-                call(autotune_prep, stdout=output, shell=True)
-                logging.info('Writing output to {filename}'.format(filename=autotune_run_filename))
+                                                 .format(run_number=run_number, date=date.strftime("%Y-%m-%d"))
+                                                 if store is None else 'autotune.current.json')
+            run_step(worker, step_cache, 'prep', [ns_treatments, profile, ns_entries, profile_pump], autotune_run_filename)
         
             # Autotune  (required args, <autotune/glucose.json> <autotune/autotune.json> <settings/profile.json>), 
             # output autotuned profile or what will be used as <autotune/autotune.json> in the next iteration
             # oref0-autotune-core autotune.$RUN_NUMBER.$DATE.json profile.json profile.pump.json > newprofile.$RUN_NUMBER.$DATE.json
         
             # oref0-autotune-core autotune.$run_number.$i.json profile.json profile.pump.json > newprofile.$RUN_NUMBER.$DATE.json
-            profile_pump = os.path.join(autotune_directory, 'profile.pump.json')
-            autotune_core = 'oref0-autotune-core {autotune_run} {profile} {profile_pump}'.format(profile=profile, profile_pump = profile_pump, autotune_run=autotune_run_filename)
-            
-            # newprofile.$RUN_NUMBER.$DATE.json
+            # newprofile.$RUN_NUMBER.$DATE.json, or newprofile.current.json with the run store
             newprofile_run_filename = os.path.join(autotune_directory, 'newprofile.{run_number}.{date}.json'
-                                                   .format(run_number=run_number, date=date.strftime("%Y-%m-%d")))
-            with open(newprofile_run_filename, "w+") as output:
-                logging.info('Running {script}'.format(script=autotune_core))
-                call(autotune_core, stdout=output, shell=True)
-                logging.info('Writing output to {filename}'.format(filename=autotune_run_filename))
+                                                   .format(run_number=run_number, date=date.strftime("%Y-%m-%d"))
+                                                   if store is None else 'newprofile.current.json')
+            run_step(worker, step_cache, 'core', [autotune_run_filename, profile, profile_pump], newprofile_run_filename)
+
+            if store is not None:
+                store.put(run_number, date, 'autotune', autotune_run_filename)
+                store.put(run_number, date, 'newprofile', newprofile_run_filename)
+                store.commit()
         
             # Copy tuned profile produced by autotune to profile.json for use with next day of data
             # cp newprofile.$RUN_NUMBER.$DATE.json profile.json
-            shutil.copy(os.path.join(autotune_directory, 'newprofile.{run_number}.{date}.json'.format(run_number=run_number, date=date.strftime("%Y-%m-%d"))),
-                        os.path.join(autotune_directory, 'profile.json'))
+            copy_file(newprofile_run_filename, os.path.join(autotune_directory, 'profile.json'))
+
+        if CONVERGE is not None:
+            with open(os.path.join(autotune_directory, 'profile.json')) as f:
+                profile = json.load(f)
+            changes = profile_changes(previous_profile, profile)
+            logging.info('Run {0} changed {1}'.format(run_number, ', '.join(
+                '{0} by {1:.2%}{2}'.format(name, change, ' at ' + where if where else '')
+                for name, (change, where) in sorted(changes.items()))))
+            if max(change for change, _ in changes.values()) <= CONVERGE:
+                logging.info('Converged after {0} of {1} runs (tolerance {2:.2%})'.format(run_number, number_of_runs, CONVERGE))
+                return run_number
+            previous_profile = profile
+    return number_of_runs
 
-def export_to_excel(output_directory, output_excel_filename):
-    autotune_export_to_xlsx = 'oref0-autotune-export-to-xlsx --dir {0} --output {1}'.format(output_directory, output_excel_filename)
-    call(autotune_export_to_xlsx, shell=True)
+SWEEP_KEYS = ('name', 'start_date', 'end_date', 'runs')
+
+def load_sweep_configurations(filename):
+    # a list of configurations, or a grid {key: [values]} expanded to every combination
+    with open(filename) as f:
+        spec = json.load(f)
+    if isinstance(spec, dict):
+        keys = sorted(spec)
+        values = [spec[key] if isinstance(spec[key], list) else [spec[key]] for key in keys]
+        spec = [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+    configurations = []
+    for item in spec:
+        unknown = set(item) - set(SWEEP_KEYS)
+        if unknown:
+            raise ValueError('Unknown sweep settings {0} in {1}'.format(', '.join(sorted(unknown)), filename))
+        start_date = datetime.datetime.strptime(item['start_date'], '%Y-%m-%d') if 'start_date' in item else START_DATE
+        end_date = datetime.datetime.strptime(item['end_date'], '%Y-%m-%d') if 'end_date' in item else END_DATE
+        runs = int(item.get('runs', NUMBER_OF_RUNS))
+        if end_date <= start_date:
+            raise ValueError('Sweep configuration {0} ends before it starts'.format(item))
+        name = item.get('name') or '{0}_{1}_{2}runs'.format(start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), runs)
+        # the name becomes a directory under autotune/sweep/ that is removed before each sweep
+        if (not isinstance(name, (str, type(u''))) or name in ('.', '..') or os.path.isabs(name)
+                or '/' in name or os.sep in name or (os.altsep and os.altsep in name)):
+            raise ValueError('Sweep configuration name {0!r} in {1} must be a plain directory name'.format(name, filename))
+        configurations.append({'name': name, 'start_date': start_date, 'end_date': end_date, 'runs': runs})
+
+    names = [c['name'] for c in configurations]
+    if len(set(names)) != len(names):
+        raise ValueError('Sweep configurations in {0} must have distinct names'.format(filename))
+    return configurations
+
+def link_data_file(source, destination):
+    # the sweep directories only read the shared downloads, so a symlink will do
+    try:
+        os.symlink(os.path.abspath(source), destination)
+    except (AttributeError, OSError):
+        shutil.copy(source, destination)
+
+def run_sweep_configuration(configuration):
+    # runs in a pool process: set up an isolated copy of DIR with links to the shared
+    # downloads, tune it, and return the final profile (None if the run failed) and
+    # the trace events of the run. Optional keys: 'dates' to tune only those days, and
+    # 'profile' for the profile to start from instead of settings/pumpprofile.json
+    directory = configuration['directory']
+    start_date, end_date = configuration['start_date'], configuration['end_date']
+    dates = configuration.get('dates') or [start_date + datetime.timedelta(days=x) for x in range(0, (end_date - start_date).days)]
+    if _tracer:
+        # this process's events go back to the parent with the profile
+        _tracer.events = []
+    try:
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(os.path.join(directory, 'autotune'))
+        os.makedirs(os.path.join(directory, 'settings'))
+        shutil.copy(os.path.join(DIR, 'settings', 'pumpprofile.json'), os.path.join(directory, 'settings', 'pumpprofile.json'))
+        get_openaps_profile(directory)
+        if configuration.get('profile'):
+            copy_file(configuration['profile'], os.path.join(directory, 'autotune', 'profile.json'))
+
+        names = [data_filename('ns-treatments.json')]
+        names += [data_filename('ns-entries.{date}.json'.format(date=date.strftime("%Y-%m-%d"))) for date in dates]
+        for name in names:
+            link_data_file(os.path.join(DIR, 'autotune', name), os.path.join(directory, 'autotune', name))
+
+        logging.info('Sweep {0}: started'.format(configuration['name']))
+        run_autotune(start_date, end_date, configuration['runs'], directory, dates)
+        with open(os.path.join(directory, 'autotune', 'profile.json')) as f:
+            profile = json.load(f)
+        logging.info('Sweep {0}: done'.format(configuration['name']))
+    except Exception:
+        logging.exception('Sweep {0} failed'.format(configuration['name']))
+        profile = None
+    return profile, _tracer.events if _tracer else []
+
+def profile_summary(profile):
+    # (parameter, value) rows comparable across profiles: ISF, CSF, carb ratio, hourly basals
+    rows = [('ISF [mg/dL/U]', profile.get('isfProfile', {}).get('sensitivities', [{}])[0].get('sensitivity')),
+            ('CSF [mg/dL/g]', profile.get('csf')),
+            ('Carb Ratio [g/U]', profile.get('carb_ratio'))]
+    basals = sorted(profile.get('basalprofile', []), key=lambda b: b.get('minutes', 0))
+    for hour in range(24):
+        rate = None
+        for basal in basals:
+            if basal.get('minutes', 0) <= hour * 60:
+                rate = basal.get('rate')
+        rows.append(('Basal {0:02d}:00'.format(hour), rate))
+    return rows
+
+def write_sweep_comparison(columns, output_filename):
+    # columns: [(heading, profile or None)]; prints the table and writes it as CSV
+    summaries = [profile_summary(profile) if profile else None for _, profile in columns]
+    parameters = [parameter for parameter, _ in profile_summary({})]
+    table = [['Parameter'] + [heading for heading, _ in columns]]
+    for row, parameter in enumerate(parameters):
+        cells = [parameter]
+        for summary in summaries:
+            value = summary[row][1] if summary else None
+            cells.append('failed' if summary is None else '' if value is None else '{0:.3f}'.format(float(value)))
+        table.append(cells)
+
+    with open(output_filename, 'w') as f:
+        for cells in table:
+            f.write(','.join(cells) + '\n')
+
+    widths = [max(len(cells[i]) for cells in table) for i in range(len(table[0]))]
+    for cells in table:
+        print('  '.join(cell.ljust(width) for cell, width in zip(cells, widths)))
+    print("Comparison: {0}".format(output_filename))
+
+def run_configurations(configurations):
+    # run_sweep_configuration for each configuration on SWEEP_JOBS processes; returns the tuned profiles
+    started = time.time()
+    pool = multiprocessing.Pool(min(SWEEP_JOBS, len(configurations)))
+    try:
+        results = pool.map(run_sweep_configuration, configurations, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if _tracer:
+        for _, events in results:
+            _tracer.events.extend(events)
+    logging.info('Tuned {0} configurations in {1:.1f}s on {2} processes'.format(
+        len(configurations), time.time() - started, min(SWEEP_JOBS, len(configurations))))
+    return [profile for profile, _ in results]
+
+def run_sweep(configurations, directory):
+    sweep_directory = os.path.join(directory, 'autotune', 'sweep')
+    for configuration in configurations:
+        configuration['directory'] = os.path.join(sweep_directory, configuration['name'])
+
+    # download the union of all date ranges once into DIR
+    start_date = min(c['start_date'] for c in configurations)
+    end_date = max(c['end_date'] for c in configurations)
+    get_openaps_profile(directory)
+    get_nightscout_carb_and_insulin_treatments(NIGHTSCOUT_HOST, start_date, end_date, directory)
+    get_nightscout_bg_entries(NIGHTSCOUT_HOST, start_date, end_date, directory)
+
+    profiles = run_configurations(configurations)
+
+    with open(os.path.join(directory, 'settings', 'pumpprofile.json')) as f:
+        pump_profile = json.load(f)
+    columns = [('Pump', pump_profile)] + [(c['name'], profile) for c, profile in zip(configurations, profiles)]
+    print()
+    print("Autotune sweep comparison:")
+    print("---------------------------------------------------------")
+    write_sweep_comparison(columns, os.path.join(sweep_directory, 'comparison.csv'))
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+def run_by_weekday(start_date, end_date, number_of_runs, directory):
+    weekday_directory = os.path.join(directory, 'autotune', 'weekday')
+    get_openaps_profile(directory)
+    get_nightscout_carb_and_insulin_treatments(NIGHTSCOUT_HOST, start_date, end_date, directory)
+    get_nightscout_bg_entries(NIGHTSCOUT_HOST, start_date, end_date, directory)
+
+    date_list = [start_date + datetime.timedelta(days=x) for x in range(0, (end_date - start_date).days)]
+    configurations = []
+    for weekday in range(1, 8):
+        dates = [date for date in date_list if date.isoweekday() == weekday]
+        if not dates:
+            logging.warning('No {0} between {1} and {2}, not tuning it'.format(
+                WEEKDAYS[weekday - 1], start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
+            continue
+        # continue from the last tuned profile for this weekday, as oref0-autotune-dayofweek.sh does
+        profile = os.path.join(directory, 'autotune', 'profile-day{0}.json'.format(weekday))
+        configurations.append({'name': 'day{0}'.format(weekday), 'weekday': weekday,
+                               'directory': os.path.join(weekday_directory, 'day{0}'.format(weekday)),
+                               'start_date': dates[0], 'end_date': dates[-1] + datetime.timedelta(days=1),
+                               'dates': dates, 'runs': number_of_runs,
+                               'profile': profile if os.path.exists(profile) else None})
+    if not configurations:
+        logging.warning('No days between {0} and {1}, nothing to tune'.format(
+            start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
+        return
+    profiles = run_configurations(configurations)
+
+    for configuration, profile in zip(configurations, profiles):
+        if profile:
+            copy_file(os.path.join(configuration['directory'], 'autotune', 'profile.json'),
+                      os.path.join(directory, 'autotune', 'profile-day{0}.json'.format(configuration['weekday'])))
+
+    with open(os.path.join(directory, 'settings', 'pumpprofile.json')) as f:
+        pump_profile = json.load(f)
+    columns = [('Pump', pump_profile)] + [('{0} ({1})'.format(WEEKDAYS[c['weekday'] - 1], len(c['dates'])), profile)
+                                          for c, profile in zip(configurations, profiles)]
+    print()
+    print("Autotune profiles by weekday (days tuned):")
+    print("---------------------------------------------------------")
+    write_sweep_comparison(columns, os.path.join(weekday_directory, 'comparison.csv'))
+
+def export_to_excel(output_directory, output_excel_filename, profiles=None):
+    # in-process, with the profiles collected by run_autotune when given; without them the exporter
+    # reads the profiles from the autotune directory (or the run store) like oref0-autotune-export-to-xlsx.
+    # The exporter, and xlsxwriter with it, are only imported here
+    output = os.path.join(output_directory, output_excel_filename)
+    with trace('oref0-autotune-export-to-xlsx', 'export') as details:
+        try:
+            import oref0_autotune_export_to_xlsx as exporter
+            if profiles is None and RUN_STORE:
+                profiles = exporter.storedProfiles(os.path.join(output_directory, 'autotune', RunStore.FILENAME))
+            exporter.export_to_xlsx(output_directory, output, profiles=profiles)
+            details['status'] = 0
+        except (ImportError, ValueError) as e:
+            logging.error('Excel export failed: {0}'.format(e))
+            details['status'] = 1
+        details['bytes_out'] = file_size(output)
 
 def create_summary_report_and_display_results(output_directory):
     print()
@@ -222,7 +1241,9 @@ def create_summary_report_and_display_results(output_directory):
     report_file = os.path.join(output_directory, 'autotune', 'autotune_recommendations.log')
     autotune_recommends_report = 'oref0-autotune-recommends-report {0}'.format(output_directory)
     
-    call(autotune_recommends_report, shell=True)
+    with trace('oref0-autotune-recommends-report', 'report') as details:
+        details['status'] = call(autotune_recommends_report, shell=True)
+        details['bytes_out'] = file_size(report_file)
     print("Recommendations Log File: {0}".format(report_file))
     
     # Go ahead and echo autotune_recommendations.log to the terminal, minus blank lines
@@ -237,17 +1258,35 @@ if __name__ == "__main__":
     
     args = get_input_arguments()
     assign_args_to_variables(args)
+
+    if TRACE:
+        start_trace()
     
     # TODO: Convert Nightscout profile to OpenAPS profile format.
     #get_nightscout_profile(NIGHTSCOUT_HOST)
     
+    if WARM_CACHE:
+        get_nightscout_carb_and_insulin_treatments(NIGHTSCOUT_HOST, START_DATE, END_DATE, DIR)
+        get_nightscout_bg_entries(NIGHTSCOUT_HOST, START_DATE, END_DATE, DIR)
+        sys.exit(0)
+
+    if SWEEP:
+        run_sweep(load_sweep_configurations(SWEEP), DIR)
+        sys.exit(0)
+
+    if BY_WEEKDAY:
+        run_by_weekday(START_DATE, END_DATE, NUMBER_OF_RUNS, DIR)
+        sys.exit(0)
+
     get_openaps_profile(DIR)
     get_nightscout_carb_and_insulin_treatments(NIGHTSCOUT_HOST, START_DATE, END_DATE, DIR)
     get_nightscout_bg_entries(NIGHTSCOUT_HOST, START_DATE, END_DATE, DIR)
-    run_autotune(START_DATE, END_DATE, NUMBER_OF_RUNS, DIR)
+    # the profiles of every run and day, handed to the exporter instead of it reading them back
+    profiles = [] if EXPORT_EXCEL else None
+    run_autotune(START_DATE, END_DATE, NUMBER_OF_RUNS, DIR, profiles=profiles)
     
     if EXPORT_EXCEL:
-        export_to_excel(DIR, EXPORT_EXCEL)
+        export_to_excel(DIR, EXPORT_EXCEL, profiles)
     
     if RECOMMENDS_REPORT:
         create_summary_report_and_display_results(DIR)
@@ -1,6 +1,15 @@
 #!/usr/bin/python
-# This script converts the json files in the autotune directory
-# to a Microsoft Excel file
+# Exports the autotune profiles of an openaps directory to a Microsoft Excel file,
+# and optionally to the CSV and columnar grids of oref0_autotune_profile_grid.py.
+#
+# Used by the oref0-autotune-export-to-xlsx command and, in-process, by
+# oref0-autotune.py, which hands over the profiles it tuned instead of having
+# them read back from disk:
+#
+#   import oref0_autotune_export_to_xlsx as exporter
+#   exporter.export_to_xlsx(openapsDirectory, 'autotune.xlsx', profiles=[(name, profile)])
+#
+# xlsxwriter is only imported once a workbook is written.
 #
 # Released under MIT license. See the accompanying LICENSE.txt file for
 # full terms and conditions
@@ -16,52 +25,27 @@
 from __future__ import print_function
 import json
 import glob, os, sys
-
-# 
-try:
-    import xlsxwriter
-except:
-    print("This software requires XlsxWriter package. Install it with 'sudo pip install XlsxWriter', see http://xlsxwriter.readthedocs.io/")
-    sys.exit(1)
-
 import datetime
 import argparse
+import functools
+import hashlib
+import multiprocessing
 import re
+import sqlite3
+import time
+import zipfile
+import oref0_autotune_profile_grid as profile_grid
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
 
 def parseDateAndRun(filename):
-    m=re.match( r'profile.(?P<run>.*).(?P<date>20[0-9][0-9]-[01][0-9]-[0-3][0-9]).json', filename)
+    m=re.match( r'.*profile\.(?P<run>[0-9]+)\.(?P<date>20[0-9][0-9]-[01][0-9]-[0-3][0-9])\.json$', filename)
     if m:
          return (m.group('date'), m.group('run'))
     else: # not found
-        return ('-','-')
-
-def calc_minutes(timestr):
-    # returns the number of minutes from midnight. seconds are ignored
-    # based on http://stackoverflow.com/questions/10663720/converting-a-time-string-to-seconds-in-python
-    ftr = [60,1,0] # ignore seconds, count minutes, and use 60 minutes per hour
-    return sum([a*b for a,b in zip(ftr, map(int,timestr.split(':')))])
-
-def expandProfile(l, valueField, offsetField):
-    r=[]
-    minutes=0
-    value=l[0][valueField]
-    for i in range(len(l)):
-        start1=l[i]['start']
-        minutes1=calc_minutes(start1)
-        offset1=l[i][offsetField]
-        if minutes1!=offset1:
-            print("Error in JSON offSetField %s contains %s does not match start time %s (%d minutes). Please report this as a bug" % (offsetField, offset1, start1, minutes1))
-            sys.exit(1)
-        while (minutes<minutes1):
-            r.append(value)
-            minutes=minutes+30
-        value=l[i][valueField]
-    # add the last value until midnight    
-    while (minutes<24*60): 
-        r.append(value)
-        minutes=minutes+30
-    # return the expanded profile
-    return r
+        return ('0','0')
 
 def writeExcelHeader(ws, date_format, headerFormat):
     ws.write_string(0,0, 'Filename', headerFormat)
@@ -74,7 +58,18 @@ def writeExcelHeader(ws, date_format, headerFormat):
             ws.write_datetime(0, col, dt, date_format)
             col=col+1
 
-def write_excel_profile(worksheet, row, expandedList, excel_number_format):
+def write_profile(worksheet, row, filename, fields, excel_number_format):
+    worksheet.write_string(row, 0, filename)
+    date, run = parseDateAndRun(filename)
+    worksheet.write_string(row, 1, date)
+    worksheet.write_string(row, 2, run)
+    col=3
+    for i in PROFILE_FIELDS:
+        if i in fields:
+           worksheet.write_number(row, col, fields[i], excel_number_format)
+        col=col+1
+    
+def write_timebased_profile(worksheet, row, filename, expandedList, excel_number_format):
     worksheet.write_string(row, 0, filename)
     date, run = parseDateAndRun(filename)
     worksheet.write_string(row, 1, date)
@@ -91,14 +86,24 @@ def excel_init_workbook(workbook):
     excel_integer_format = workbook.add_format({'num_format': '0', 'font_size': '16'})
     headerFormat = workbook.add_format({'bold': True, 'font_color': 'black'})
     worksheetInfo = workbook.add_worksheet('Read this first')
+
+    worksheetProfile = workbook.add_worksheet('Profile')
+    worksheetProfile.write_string(0,0, 'Filename', headerFormat)
+    worksheetProfile.write_string(0,1, 'Date', headerFormat)
+    worksheetProfile.write_string(0,2, 'Run', headerFormat)
+    col=3
+    for colName in PROFILE_FIELDS:
+        worksheetProfile.write_string(0,col, colName, headerFormat)
+        col=col+1
+
     worksheetIsf = workbook.add_worksheet('isfProfile')
     worksheetBasal = workbook.add_worksheet('basalProfile') 
     writeExcelHeader(worksheetBasal, excel_hour_format,headerFormat)
     writeExcelHeader(worksheetIsf, excel_hour_format,headerFormat)
     worksheetBasal.autofilter('A1:C999')
     worksheetIsf.autofilter('A1:C999')
-    worksheetBasal.set_column(3, 50, 6) # set columns starting from 3 to width 6
-    worksheetIsf.set_column(3, 50, 5) # set columns starting from 3 to width 5
+    worksheetBasal.set_column(3, 50, 6) # set columns starting from 3 to same width
+    worksheetIsf.set_column(3, 50, 6) # set columns starting from 3 to same width
     infoText=['Released under MIT license. See the accompanying LICENSE.txt file for', 'full terms and conditions', '']
     infoText.append('THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR')
     infoText.append('IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,')
@@ -111,32 +116,304 @@ def excel_init_workbook(workbook):
     for i in range(len(infoText)):
         worksheetInfo.write_string(row, 1, infoText[i])
         row=row+1
-    return (worksheetBasal, worksheetIsf, excel_2decimals_format, excel_integer_format)
+    return (worksheetProfile, worksheetBasal, worksheetIsf, excel_2decimals_format, excel_integer_format)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Export oref0 autotune files to Microsoft Excel')
-    parser.add_argument('-d', '--dir', help='autotune directory', default='.')
-    parser.add_argument('-o', '--output', help='default autotune.xlsx', default='autotune.xlsx')
-    parser.add_argument('--version', action='version', version='%(prog)s 0.0.2-dev')
-    args = parser.parse_args()
+# sort filenames (relative to the openaps directory). First on date and then on run number
+# put settings/profile.js
+def sortedFilenames(directory='.'):
+    def found(pattern):
+        return [os.path.relpath(f, directory) for f in glob.glob(os.path.join(directory, pattern))]
+    filelist=found("settings/profile.json")
+    filelist=filelist+found("settings/pumpprofile.json")
+    profiles=found("autotune/profile*.json")
+    return filelist+sorted(profiles, key=lambda f: (sortKey(f), f))
+
+def sortKey(filename):
+    date, run = parseDateAndRun(filename)
+    return "%s-%3d" % (date,int(run))
 
-    # change to autotune directory
-    os.chdir(args.dir)
-
-    print("Writing headers to Microsoft Excel file %s" % args.output)
-    workbook = xlsxwriter.Workbook(args.output)
-    (worksheetBasal, worksheetIsf,excel_2decimals_format,excel_integer_format)=excel_init_workbook(workbook)
-    row=1 # start on second row, row=0 is for headers
-    filenamelist=glob.glob("profile.json")+glob.glob("profile.pump.json")+glob.glob("profile.[0-9].*.json")+glob.glob("profile.[0-9][0-9].*.json")
-    for filename in filenamelist:
-        f=open(filename, 'r')
-        print("Adding %s to Excel" % filename)
-        j=json.load(f)
+# profiles kept in the autotune run store (oref0-autotune.py --run-store) instead of
+# autotune/profile.<run>.<date>.json files, sorted the same way and named after the
+# files they replace
+def storedProfiles(store):
+    db=sqlite3.connect(store)
+    try:
+        rows=db.execute("SELECT run, date, output FROM steps WHERE kind='profile' ORDER BY date, run").fetchall()
+    finally:
+        db.close()
+    return [("autotune/profile.%d.%s.json" % (run, date), output) for (run, date, output) in rows]
+
+# parse one profile into what goes into the workbook. item is (filename, profile) with profile
+# either a profile already loaded, its JSON text, or None to read it from filename in directory.
+# Runs in the worker pool; returns (filename, (expandedBasal, expandedIsf, expandedCarbRatio, fields), None)
+# or (filename, None, reason to skip it). expandedCarbRatio is None for profiles without carb_ratios
+def parseProfile(directory, item):
+    (filename, text)=item
+    if text is None:
+        with open(os.path.join(directory, filename), 'r') as f:
+            text=f.read()
+    j=None
+    try:
+        j=text if isinstance(text, dict) else json.loads(text)
         basalProfile=j['basalprofile']
         isfProfile=j['isfProfile']['sensitivities']
-        expandedBasal=expandProfile(basalProfile, 'rate', 'minutes')
-        expandedIsf=expandProfile(isfProfile, 'sensitivity', 'offset')
-        write_excel_profile(worksheetBasal, row, expandedBasal, excel_2decimals_format)
-        write_excel_profile(worksheetIsf, row, expandedIsf, excel_integer_format)
-        row=row+1
-    workbook.close()  
+        expandedBasal=profile_grid.schedule_slots(basalProfile, 'rate', 'minutes')
+        expandedIsf=profile_grid.schedule_slots(isfProfile, 'sensitivity', 'offset')
+        carbRatios=j.get('carb_ratios', {}).get('schedule')
+        expandedCarbRatio=profile_grid.schedule_slots(carbRatios, 'ratio', 'offset') if carbRatios else None
+        fields=dict((i, j[i]) for i in PROFILE_FIELDS if i in j)
+        return (filename, (expandedBasal, expandedIsf, expandedCarbRatio, fields), None)
+    except profile_grid.ScheduleError as e: # corrupt profile, stop the export
+        print(e)
+        return (filename, None, None)
+    except Exception as e:
+        if isinstance(j, dict) and 'error' in j:
+            return (filename, None, "Error: %s " % j['error'])
+        else:
+            return (filename, None, "Exception: %s" % e)
+
+# manifest of an incremental export (--incremental): the outputs written, the number of rows in
+# the workbook and the mtime, size, sha256 and workbook row (None if skipped) of each exported
+# profile, in export order
+def loadManifest(manifestFile):
+    try:
+        with open(manifestFile, 'r') as f:
+            manifest=json.load(f)
+    except (IOError, OSError, ValueError):
+        return {'files': []}
+    if manifest.get('version')!=MANIFEST_VERSION:
+        return {'files': []}
+    return manifest
+
+def saveManifest(manifestFile, manifest):
+    manifest['version']=MANIFEST_VERSION
+    with open(manifestFile+'.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(manifestFile+'.tmp', manifestFile)
+
+# returns the manifest entry of a profile and its text. A file with the mtime and size of old
+# (its entry in the previous manifest) is taken as unchanged and not read; its text is then None
+def manifestEntry(directory, filename, text, old):
+    entry={'filename': filename}
+    if text is None:
+        st=os.stat(os.path.join(directory, filename))
+        entry['mtime']=st.st_mtime
+        entry['size']=st.st_size
+        if old and old.get('mtime')==entry['mtime'] and old.get('size')==entry['size']:
+            entry['sha256']=old['sha256']
+            return (entry, None)
+        with open(os.path.join(directory, filename), 'r') as f:
+            text=f.read()
+    data=json.dumps(text, sort_keys=True) if isinstance(text, dict) else text
+    entry['sha256']=hashlib.sha256(data.encode('utf-8')).hexdigest()
+    return (entry, text)
+
+# xlsxwriter cannot change an existing workbook. rowsWorkbook is written the same way as output
+# (same sheets and formats) but holds only the rows that changed or are new: copy output with
+# these rows merged into each sheet. Constant memory workbooks keep their strings inline in the
+# sheets, so the rows do not refer to anything else in the file
+def mergeIntoWorkbook(output, rowsWorkbook):
+    old=zipfile.ZipFile(output)
+    new=zipfile.ZipFile(rowsWorkbook)
+    try:
+        out=zipfile.ZipFile(output+'.tmp', 'w', zipfile.ZIP_DEFLATED)
+        for info in old.infolist():
+            data=old.read(info.filename)
+            if info.filename.startswith('xl/worksheets/sheet') and info.filename in new.namelist():
+                data=mergeRows(data.decode('utf-8'), new.read(info.filename).decode('utf-8')).encode('utf-8')
+            out.writestr(info, data)
+        out.close()
+    finally:
+        old.close()
+        new.close()
+    os.rename(output+'.tmp', output)
+
+SHEET_ROW=re.compile(r'<row r="([0-9]+)"[^>]*?(?:/>|>.*?</row>)', re.S)
+SHEET_DIMENSION=re.compile(r'<dimension ref="([^"]*)"/>')
+
+# sheet XML with the rows of newSheet replacing those with the same number in sheet, or added
+# in row order, and the dimension covering both
+def mergeRows(sheet, newSheet):
+    rows=dict((int(m.group(1)), m.group(0)) for m in SHEET_ROW.finditer(sheet))
+    rows.update((int(m.group(1)), m.group(0)) for m in SHEET_ROW.finditer(newSheet))
+    refs=[SHEET_DIMENSION.search(xml).group(1) for xml in (sheet, newSheet)]
+    ref=max(refs, key=lambda r: int(re.search(r'[0-9]+$', r).group(0)))
+    start=sheet.index('<sheetData>')+len('<sheetData>')
+    end=sheet.index('</sheetData>')
+    sheet=sheet[:start]+''.join(rows[r] for r in sorted(rows))+sheet[end:]
+    return SHEET_DIMENSION.sub('<dimension ref="%s"/>' % ref, sheet, 1)
+
+def peakRssMB(who):
+    # peak resident set size in MB of this process (who=RUSAGE_SELF) or its largest child
+    if resource is None:
+        return float('nan')
+    peak=resource.getrusage(who).ru_maxrss
+    return peak/1024.0/1024.0 if sys.platform=='darwin' else peak/1024.0
+
+# global constants
+PROFILE_FIELDS=['max_iob', 'carb_ratio', 'csf', 'max_basal', 'sens']
+MANIFEST_VERSION=2
+
+XLSXWRITER_MISSING="This software requires XlsxWriter package. Install it with 'sudo pip install XlsxWriter', see http://xlsxwriter.readthedocs.io/"
+
+def export_to_xlsx(directory, output, profiles=None, csvFile=None, columnarFile=None, jobs=1, incremental=False):
+    """Export the profiles of the openaps directory to the workbook output.
+
+    profiles, [(filename, profile)] with filename as in autotune/profile.<run>.<date>.json and
+    profile a loaded profile or its JSON text, replaces the per run and day files of the
+    autotune directory; the settings profiles and autotune/profile.json are always read from
+    directory. csvFile and columnarFile also write the 30 minute grid, jobs>1 parses profiles
+    on that many processes, and incremental only rewrites the rows of changed settings profiles
+    and adds new run and day profiles to the outputs of the last incremental export. Raises ImportError without xlsxwriter, and ScheduleError (a ValueError)
+    for a corrupt profile.
+    """
+    try:
+        import xlsxwriter
+    except ImportError:
+        print(XLSXWRITER_MISSING)
+        raise
+
+    started=time.time()
+    filenames=sortedFilenames(directory)
+    if profiles is not None:
+        # per run and day profiles come from the caller; files left over from earlier runs are skipped
+        filenames=[f for f in filenames if f.startswith('settings/') or parseDateAndRun(f)==('0','0')]
+    profiles=[(filename, None) for filename in filenames]+sorted(profiles or [], key=lambda p: (sortKey(p[0]), p[0]))
+    outputs={'xlsx': output, 'csv': csvFile, 'columnar': columnarFile}
+    manifestFile=output+'.manifest.json'
+    previous=loadManifest(manifestFile) if incremental else {'files': []}
+    previousEntries=dict((e['filename'], e) for e in previous['files'])
+    entries=[] # manifest entries, one per profile in export order
+    for (i, (filename, text)) in enumerate(profiles):
+        if incremental:
+            (entry, text)=manifestEntry(directory, filename, text, previousEntries.get(filename))
+            profiles[i]=(filename, text)
+        else:
+            entry={'filename': filename}
+        entries.append(entry)
+
+    # The settings profiles and autotune/profile.json sort first and change with every tune: their
+    # rows are rewritten in place. The run and day profiles exported last time must be there unchanged
+    # and in the same order; the new ones sort after them and are added at the end
+    def dated(entry):
+        return parseDateAndRun(entry['filename'])!=('0','0')
+    fixed=[i for (i, e) in enumerate(entries) if not dated(e)]
+    previousDated=[e for e in previous['files'] if dated(e)]
+    datedIndexes=[i for (i, e) in enumerate(entries) if dated(e)]
+    append=(incremental and len(previous['files'])>0 and previous.get('outputs')==outputs
+            and all(os.path.exists(o) for o in outputs.values() if o)
+            and [entries[i]['filename'] for i in fixed]==[e['filename'] for e in previous['files'] if not dated(e)]
+            and len(previousDated)<=len(datedIndexes)
+            and all(entries[i]['filename']==e['filename'] and entries[i]['sha256']==e['sha256'] for (i, e) in zip(datedIndexes, previousDated)))
+    results={} # profile index: parse result, for the profiles parsed before the workbook is written
+    if append:
+        changedFixed=[i for i in fixed if entries[i]['sha256']!=previousEntries[entries[i]['filename']]['sha256']]
+        for i in changedFixed:
+            results[i]=parseProfile(directory, profiles[i])
+            # a row can be rewritten in place, but not added or removed
+            if (results[i][1] is None)!=(previousEntries[entries[i]['filename']]['row'] is None):
+                append=False
+        toWrite=changedFixed+datedIndexes[len(previousDated):]
+        if append and not toWrite:
+            print("No new or changed profiles since the last export of %s" % output)
+            return
+    if not append:
+        toWrite=list(range(len(profiles)))
+    if incremental:
+        changed=len([e for e in entries if previousEntries.get(e['filename'], {}).get('sha256')!=e['sha256']])
+        print("%d of %d profiles are new or changed, %s" % (changed, len(entries), "merging them" if append else "exporting all"))
+        if append:
+            for entry in entries:
+                entry['row']=previousEntries.get(entry['filename'], {}).get('row')
+
+    workbookFile=output+'.new.xlsx' if append else output
+    print("Writing headers to Microsoft Excel file %s" % workbookFile)
+    # constant_memory streams each row to disk once the next one starts, so memory use does not
+    # grow with the number of profiles; rows therefore have to be written in order
+    workbook = xlsxwriter.Workbook(workbookFile, {'constant_memory': True})
+    (worksheetProfile,worksheetBasal, worksheetIsf,excel_2decimals_format,excel_integer_format)=excel_init_workbook(workbook)
+    row=previous['rows'] if append else 1 # start on second row, row=0 is for headers
+    grid=profile_grid.ProfileGrid() if csvFile or columnarFile else None # rows written by this export
+    toParse=[profiles[i] for i in toWrite if i not in results]
+    pool=multiprocessing.Pool(jobs) if jobs>1 and len(toParse)>1 else None
+    try:
+        # parsed in parallel, written in the original order
+        parse=functools.partial(parseProfile, directory)
+        parsed=pool.imap(parse, toParse, 16) if pool else (parse(p) for p in toParse)
+        for i in toWrite:
+            (filename, data, skipped)=results[i] if i in results else next(parsed)
+            print("Adding %s to Excel" % filename)
+            if data is None:
+                if skipped is None:
+                    raise profile_grid.ScheduleError("Stopped exporting at the corrupt profile %s" % filename)
+                print("Skipping file. %s" % skipped)
+                entries[i]['row']=None
+                continue
+            if append and i in fixed:
+                entryRow=entries[i]['row']
+            else:
+                entryRow=row
+                row=row+1
+            entries[i]['row']=entryRow
+            (expandedBasal, expandedIsf, expandedCarbRatio, fields)=data
+            write_timebased_profile(worksheetBasal, entryRow, filename, expandedBasal, excel_2decimals_format)
+            write_timebased_profile(worksheetIsf, entryRow, filename, expandedIsf, excel_integer_format)
+            write_profile(worksheetProfile, entryRow, filename, fields, excel_integer_format)
+            if grid is not None:
+                grid.append(filename, {'basal': expandedBasal, 'isf': expandedIsf, 'carb_ratio': expandedCarbRatio})
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    workbook.close()
+    if append:
+        mergeIntoWorkbook(output, workbookFile)
+        os.remove(workbookFile)
+    print("Written %d lines to Excel" % row)
+    if grid is not None:
+        if append:
+            # the grid of the last export, with the rewritten rows replaced and the new ones added
+            allRows=profile_grid.ProfileGrid.read_columnar(columnarFile) if columnarFile else profile_grid.ProfileGrid.read_csv(csvFile)
+            for (i, name) in enumerate(grid.names):
+                slots=dict((schedule, grid.row(schedule, i)) for schedule in profile_grid.SCHEDULE_NAMES)
+                if name in allRows.names and parseDateAndRun(name)==('0','0'):
+                    allRows.set_row(allRows.names.index(name), slots)
+                else:
+                    allRows.append(name, slots)
+            grid=allRows
+        if csvFile:
+            grid.write_csv(csvFile)
+            print("Written %d profiles to %s" % (len(grid), csvFile))
+        if columnarFile:
+            grid.write_columnar(columnarFile)
+            print("Written %d profiles to %s" % (len(grid), columnarFile))
+    if incremental:
+        saveManifest(manifestFile, {'outputs': outputs, 'rows': row, 'files': entries})
+    elapsed=time.time()-started
+    report="Exported %d files in %.1fs (%.0f files/sec); peak RSS %.1f MB" % (
+        len(toWrite), elapsed, len(toWrite)/max(elapsed, 1e-6), peakRssMB(resource.RUSAGE_SELF if resource else None))
+    if pool:
+        report+=", largest of %d parsing processes %.1f MB" % (jobs, peakRssMB(resource.RUSAGE_CHILDREN if resource else None))
+    print(report)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export oref0 autotune files to Microsoft Excel')
+    parser.add_argument('-d', '--dir', help='openaps directory', default='.')
+    parser.add_argument('-o', '--output', help='default autotune.xlsx, relative to the openaps directory', default='autotune.xlsx')
+    parser.add_argument('-s', '--store', help='read the autotune profiles from this run store (runs.sqlite)')
+    parser.add_argument('--csv', help='also write the 30 minute basal, ISF and carb ratio grid to this CSV file')
+    parser.add_argument('--columnar', help='also write the 30 minute grid to this binary columnar file (see oref0_autotune_profile_grid.py)')
+    parser.add_argument('-i', '--incremental', action='store_true', help='only rewrite changed settings profiles and add new run and day profiles to the outputs of the last incremental export, instead of exporting all of them again (keeps OUTPUT.manifest.json)')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help='processes parsing profiles, default one per CPU core')
+    parser.add_argument('--version', action='version', version='%(prog)s 0.0.4-dev')
+    args = parser.parse_args()
+
+    try:
+        export_to_xlsx(args.dir, os.path.join(args.dir, args.output),
+                       profiles=storedProfiles(args.store) if args.store else None,
+                       csvFile=args.csv, columnarFile=args.columnar, jobs=args.jobs, incremental=args.incremental)
+    except (ImportError, profile_grid.ScheduleError):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
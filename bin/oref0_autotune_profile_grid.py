@@ -0,0 +1,192 @@
+# Turns the basal, ISF and carb ratio schedules of oref0 profiles into a dense
+# grid of 30 minute slots (one row of 48 values per profile and schedule), and
+# writes that grid as CSV or as a compact binary columnar file.
+#
+# Used by oref0_autotune_export_to_xlsx.py; can be imported by anything that
+# wants to analyse many autotune profiles without going through Excel:
+#
+#   grid=ProfileGrid.from_profiles([(name, json.load(open(name))) for name in filenames])
+#   grid.write_csv('profiles.csv')
+#   grid.write_columnar('profiles.grid')
+#   grid=ProfileGrid.read_columnar('profiles.grid')
+#   grid.row('basal', 0) # 48 basal rates of the first profile
+#
+# Released under MIT license. See the accompanying LICENSE.txt file for
+# full terms and conditions
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import print_function
+import csv
+import json
+import struct
+import sys
+from array import array
+
+SLOT_MINUTES=30
+SLOTS=24*60//SLOT_MINUTES
+
+# schedule name, path to the schedule in the profile, value field, offset field (minutes from midnight)
+SCHEDULES=[
+    ('basal', ('basalprofile',), 'rate', 'minutes'),
+    ('isf', ('isfProfile', 'sensitivities'), 'sensitivity', 'offset'),
+    ('carb_ratio', ('carb_ratios', 'schedule'), 'ratio', 'offset'),
+]
+SCHEDULE_NAMES=[name for (name, path, valueField, offsetField) in SCHEDULES]
+
+# binary columnar file: MAGIC, little endian uint32 header length, JSON header, then for each
+# schedule in header['columns'] rows*slots little endian float64 values, row after row.
+# Slots of schedules a profile does not have are NaN. numpy can map the columns directly, e.g.
+# numpy.frombuffer(data, '<f8', rows*slots, offset).reshape(rows, slots)
+MAGIC=b'OREF0GRD'
+FORMAT_VERSION=1
+
+NAN=float('nan')
+
+class ScheduleError(ValueError):
+    """A schedule entry whose start time does not match its offset."""
+
+def slot_labels():
+    return ['%02d:%02d' % divmod(slot*SLOT_MINUTES, 60) for slot in range(SLOTS)]
+
+def _fill_schedule(column, base, schedule, valueField, offsetField):
+    # fill column[base:base+SLOTS] from the schedule. Each value holds from the first slot starting
+    # at or after its offset until the next entry; the first value also covers the slots before it
+    slot=0
+    value=schedule[0][valueField]
+    for entry in schedule:
+        offset=entry[offsetField]
+        start=entry['start']
+        if start[:5]!='%02d:%02d' % divmod(offset, 60):
+            raise ScheduleError("Error in JSON offSetField %s contains %s does not match start time %s. Please report this as a bug" % (offsetField, offset, start))
+        end=min(-(-offset//SLOT_MINUTES), SLOTS)
+        if end>slot:
+            column[base+slot:base+end]=array('d', [value])*(end-slot)
+            slot=end
+        value=entry[valueField]
+    if slot<SLOTS:
+        column[base+slot:base+SLOTS]=array('d', [value])*(SLOTS-slot)
+
+def schedule_slots(schedule, valueField, offsetField):
+    """Expand one schedule into a list of SLOTS values."""
+    column=array('d', [NAN])*SLOTS
+    _fill_schedule(column, 0, schedule, valueField, offsetField)
+    return column.tolist()
+
+def _find_schedule(profile, path):
+    for key in path:
+        if not isinstance(profile, dict) or key not in profile:
+            return None
+        profile=profile[key]
+    return profile or None
+
+class ProfileGrid(object):
+    """Named rows of SLOTS values per schedule, kept as one flat float64 array per schedule."""
+
+    def __init__(self, names=None, columns=None):
+        self.names=list(names or [])
+        self.columns=columns or dict((name, array('d')) for name in SCHEDULE_NAMES)
+
+    @classmethod
+    def from_profiles(cls, profiles):
+        """Build the grid from [(name, profile dict)] in one pass over preallocated columns."""
+        profiles=list(profiles)
+        grid=cls([name for (name, profile) in profiles],
+                 dict((name, array('d', [NAN])*(len(profiles)*SLOTS)) for name in SCHEDULE_NAMES))
+        for (i, (name, profile)) in enumerate(profiles):
+            for (schedule, path, valueField, offsetField) in SCHEDULES:
+                entries=_find_schedule(profile, path)
+                if entries:
+                    _fill_schedule(grid.columns[schedule], i*SLOTS, entries, valueField, offsetField)
+        return grid
+
+    def append(self, name, slots):
+        """Add a row from {schedule name: SLOTS values}; missing schedules are NaN."""
+        self.names.append(name)
+        for schedule in SCHEDULE_NAMES:
+            values=slots.get(schedule)
+            self.columns[schedule].extend(values if values is not None else array('d', [NAN])*SLOTS)
+
+    def __len__(self):
+        return len(self.names)
+
+    def row(self, schedule, i):
+        return self.columns[schedule][i*SLOTS:(i+1)*SLOTS].tolist()
+
+    def set_row(self, i, slots):
+        """Replace row i with {schedule name: SLOTS values}; missing schedules become NaN."""
+        for schedule in SCHEDULE_NAMES:
+            values=slots.get(schedule)
+            self.columns[schedule][i*SLOTS:(i+1)*SLOTS]=array('d', values if values is not None else [NAN]*SLOTS)
+
+    def write_csv(self, filename):
+        # one line per profile and schedule, schedules a profile does not have are left out
+        with open(filename, 'w') as f:
+            writer=csv.writer(f, lineterminator='\n')
+            writer.writerow(['name', 'schedule']+slot_labels())
+            for (i, name) in enumerate(self.names):
+                for schedule in SCHEDULE_NAMES:
+                    values=self.row(schedule, i)
+                    if values[0]==values[0]: # not NaN
+                        writer.writerow([name, schedule]+['%g' % v for v in values])
+
+    @classmethod
+    def read_csv(cls, filename):
+        # values come back as written, with the 6 significant digits of write_csv
+        slots={}
+        names=[]
+        with open(filename, 'r') as f:
+            reader=csv.reader(f)
+            next(reader) # header
+            for line in reader:
+                (name, schedule)=line[:2]
+                if name not in slots:
+                    slots[name]={}
+                    names.append(name)
+                slots[name][schedule]=[float(v) for v in line[2:]]
+        grid=cls()
+        for name in names:
+            grid.append(name, slots[name])
+        return grid
+
+    def write_columnar(self, filename):
+        header=json.dumps({'version': FORMAT_VERSION, 'rows': len(self.names), 'slots': SLOTS,
+                           'slot_minutes': SLOT_MINUTES, 'names': self.names, 'columns': SCHEDULE_NAMES}).encode('utf-8')
+        with open(filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for schedule in SCHEDULE_NAMES:
+                column=self.columns[schedule]
+                if sys.byteorder!='little':
+                    column=array('d', column)
+                    column.byteswap()
+                f.write(column.tobytes() if hasattr(column, 'tobytes') else column.tostring())
+
+    @classmethod
+    def read_columnar(cls, filename):
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC))!=MAGIC:
+                raise ValueError("%s is not a profile grid file" % filename)
+            (length,)=struct.unpack('<I', f.read(4))
+            header=json.loads(f.read(length).decode('utf-8'))
+            if header['version']!=FORMAT_VERSION or header['slots']!=SLOTS:
+                raise ValueError("%s: unsupported profile grid version %s with %s slots" % (filename, header['version'], header['slots']))
+            columns={}
+            for schedule in header['columns']:
+                column=array('d')
+                data=f.read(8*header['rows']*SLOTS)
+                if hasattr(column, 'frombytes'):
+                    column.frombytes(data)
+                else:
+                    column.fromstring(data)
+                if sys.byteorder!='little':
+                    column.byteswap()
+                columns[schedule]=column
+        return cls(header['names'], columns)
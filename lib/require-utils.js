@@ -1,6 +1,7 @@
 'use strict';
 
 var fs = require('fs');
+var zlib = require('zlib');
 
 function safeRequire (path) {
   var resolved;
@@ -24,8 +25,21 @@ function requireWithTimestamp (path) {
   return resolved;
 }
 
+// Read a text file, gunzipping it first if the name ends in .gz
+// (oref0-autotune.py can store Nightscout downloads compressed)
+function readFileMaybeGzipped (path) {
+  var data = fs.readFileSync(path);
+
+  if (/\.gz$/.test(path)) {
+    data = zlib.gunzipSync(data);
+  }
+
+  return data.toString('utf8');
+}
+
 
 module.exports = {
   safeRequire: safeRequire
   , requireWithTimestamp: requireWithTimestamp
+  , readFileMaybeGzipped: readFileMaybeGzipped
 };
\ No newline at end of file
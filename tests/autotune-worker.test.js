@@ -0,0 +1,34 @@
+'use strict';
+
+require('should');
+
+var fs = require('fs');
+var os = require('os');
+var path = require('path');
+
+describe('oref0-autotune-worker runJob', function ( ) {
+    var runJob = require('../bin/oref0-autotune-worker');
+    var dir;
+
+    before(function () {
+      dir = fs.mkdtempSync(path.join(os.tmpdir(), 'oref0-autotune-worker-'));
+    });
+
+    after(function () {
+      fs.readdirSync(dir).forEach(function (name) { fs.unlinkSync(path.join(dir, name)); });
+      fs.rmdirSync(dir);
+    });
+
+    it('should leave the output of a failed job empty', function () {
+      var output = path.join(dir, 'newprofile.current.json');
+      fs.writeFileSync(output, '{"from": "yesterday"}');
+      (function () { runJob({ command: 'nonesuch', args: [], output: output }); }).should.throw(/unknown command/);
+      fs.readFileSync(output, 'utf8').should.equal('');
+    });
+
+    it('should write what the command line tool prints', function () {
+      var output = path.join(dir, 'newprofile.json');
+      runJob({ command: 'core', args: [path.join(dir, 'missing.json'), path.join(dir, 'missing.json'), path.join(dir, 'missing.json')], output: output });
+      JSON.parse(fs.readFileSync(output, 'utf8')).error.should.equal('Could not parse input data');
+    });
+});
@@ -0,0 +1,34 @@
+'use strict';
+
+require('should');
+
+var fs = require('fs');
+var os = require('os');
+var path = require('path');
+var zlib = require('zlib');
+
+describe('readFileMaybeGzipped', function ( ) {
+    var readFileMaybeGzipped = require('../lib/require-utils').readFileMaybeGzipped;
+    var dir;
+
+    before(function () {
+      dir = fs.mkdtempSync(path.join(os.tmpdir(), 'oref0-require-utils-'));
+    });
+
+    after(function () {
+      fs.readdirSync(dir).forEach(function (name) { fs.unlinkSync(path.join(dir, name)); });
+      fs.rmdirSync(dir);
+    });
+
+    it('should read plain files', function () {
+      var file = path.join(dir, 'entries.json');
+      fs.writeFileSync(file, '[{"sgv": 100}]');
+      JSON.parse(readFileMaybeGzipped(file))[0].sgv.should.equal(100);
+    });
+
+    it('should gunzip files ending in .gz', function () {
+      var file = path.join(dir, 'entries.json.gz');
+      fs.writeFileSync(file, zlib.gzipSync('[{"sgv": 101}]'));
+      JSON.parse(readFileMaybeGzipped(file))[0].sgv.should.equal(101);
+    });
+});
@@ -0,0 +1,127 @@
+# Tests of the incremental export of bin/oref0_autotune_export_to_xlsx.py:
+# run with python -m pytest tests/ or python -m unittest discover tests
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+import oref0_autotune_export_to_xlsx as exporter
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+def profile(isf, basal=1.0):
+    return {'basalprofile': [{'i': 0, 'minutes': 0, 'start': '00:00:00', 'rate': basal},
+                             {'i': 1, 'minutes': 360, 'start': '06:00:00', 'rate': basal+0.2}],
+            'isfProfile': {'sensitivities': [{'i': 0, 'offset': 0, 'start': '00:00:00', 'sensitivity': isf}]},
+            'carb_ratios': {'schedule': [{'i': 0, 'offset': 0, 'start': '00:00:00', 'ratio': 10}]},
+            'max_iob': 3, 'carb_ratio': 10, 'sens': isf, 'max_basal': 2}
+
+def sheets(filename):
+    # {sheet: ([row numbers], dimension)} and {sheet: [(cell, value)]} of a workbook
+    z=zipfile.ZipFile(filename)
+    rows={}
+    cells={}
+    for name in z.namelist():
+        if name.startswith('xl/worksheets/sheet'):
+            xml=z.read(name).decode('utf-8')
+            rows[name]=([int(r) for r in re.findall(r'<row r="([0-9]+)"', xml)],
+                        re.search(r'<dimension ref="([^"]*)"/>', xml).group(1))
+            cells[name]=re.findall(r'<c r="([A-Z]+[0-9]+)"[^>]*>(.*?)</c>', xml)
+    z.close()
+    return (rows, cells)
+
+class MergeRowsTest(unittest.TestCase):
+
+    def test_rows_are_replaced_or_added_in_order(self):
+        sheet=('<worksheet><dimension ref="A1:C3"/><sheetData>'
+               '<row r="1"><c r="A1"/></row><row r="2"><c r="A2">old</c></row><row r="3"><c r="A3"/></row>'
+               '</sheetData></worksheet>')
+        newSheet=('<worksheet><dimension ref="A1:C5"/><sheetData>'
+                  '<row r="1"><c r="A1"/></row><row r="2"><c r="A2">new</c></row><row r="5" spans="1:3"/>'
+                  '</sheetData></worksheet>')
+        merged=exporter.mergeRows(sheet, newSheet)
+        self.assertEqual(re.findall(r'<row r="([0-9]+)"', merged), ['1', '2', '3', '5'])
+        self.assertIn('<c r="A2">new</c>', merged)
+        self.assertNotIn('old', merged)
+        self.assertIn('<dimension ref="A1:C5"/>', merged)
+
+    def test_dimension_is_kept_when_only_earlier_rows_change(self):
+        sheet='<dimension ref="A1:C9"/><sheetData><row r="1"/><row r="9"><c r="A9"/></row></sheetData>'
+        newSheet='<dimension ref="A1:C2"/><sheetData><row r="1"/><row r="2"><c r="A2"/></row></sheetData>'
+        merged=exporter.mergeRows(sheet, newSheet)
+        self.assertEqual(re.findall(r'<row r="([0-9]+)"', merged), ['1', '2', '9'])
+        self.assertIn('<dimension ref="A1:C9"/>', merged)
+
+@unittest.skipIf(xlsxwriter is None, 'needs XlsxWriter')
+class IncrementalExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp(prefix='oref0-export-')
+        for sub in ('settings', 'autotune'):
+            os.mkdir(os.path.join(self.directory, sub))
+        self.write('settings/profile.json', profile(50))
+        self.write('autotune/profile.json', profile(50))
+        for day in (1, 2, 3):
+            self.write('autotune/profile.1.2020-01-0%d.json' % day, profile(50+day))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            json.dump(data, f)
+
+    def export(self, output, incremental):
+        exporter.export_to_xlsx(self.directory, os.path.join(self.directory, output),
+                                csvFile=os.path.join(self.directory, output+'.csv'),
+                                columnarFile=os.path.join(self.directory, output+'.grid'),
+                                incremental=incremental)
+
+    def assertSameExport(self, output, full):
+        self.assertEqual(sheets(os.path.join(self.directory, output)), sheets(os.path.join(self.directory, full)))
+        for suffix in ('.csv', '.grid'):
+            with open(os.path.join(self.directory, output+suffix), 'rb') as a:
+                with open(os.path.join(self.directory, full+suffix), 'rb') as b:
+                    self.assertEqual(a.read(), b.read())
+
+    def test_nightly_tune_is_merged(self):
+        self.export('i.xlsx', True)
+        # a nightly tune: autotune/profile.json rewritten and a new day added
+        self.write('autotune/profile.json', profile(60, 1.1))
+        self.write('autotune/profile.1.2020-01-04.json', profile(54))
+        original=exporter.parseProfile
+        parsed=[]
+        def counting(directory, item):
+            parsed.append(item[0])
+            return original(directory, item)
+        exporter.parseProfile=counting
+        try:
+            self.export('i.xlsx', True)
+        finally:
+            exporter.parseProfile=original
+        self.assertEqual(sorted(parsed), ['autotune/profile.1.2020-01-04.json', 'autotune/profile.json'])
+        self.export('full.xlsx', False)
+        self.assertSameExport('i.xlsx', 'full.xlsx')
+        (rows, cells)=sheets(os.path.join(self.directory, 'i.xlsx'))
+        # Read this first, Profile, isfProfile, basalProfile
+        self.assertEqual(rows['xl/worksheets/sheet2.xml'], ([1, 2, 3, 4, 5, 6, 7], 'A1:H7'))
+        self.assertEqual(rows['xl/worksheets/sheet4.xml'][1], 'A1:AY7')
+
+    def test_changed_run_profile_exports_all(self):
+        self.export('i.xlsx', True)
+        self.write('autotune/profile.1.2020-01-02.json', profile(70))
+        self.export('i.xlsx', True)
+        self.export('full.xlsx', False)
+        self.assertSameExport('i.xlsx', 'full.xlsx')
+
+if __name__ == '__main__':
+    unittest.main()
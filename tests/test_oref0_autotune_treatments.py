@@ -0,0 +1,114 @@
+# Tests of the windowed Nightscout treatments download of bin/oref0-autotune.py:
+# run with python -m pytest tests/ or python -m unittest discover tests
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'oref0-autotune.py')
+
+def load_autotune():
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('oref0_autotune', SCRIPT)
+    spec = importlib.util.spec_from_file_location('oref0_autotune', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class Response(object):
+
+    def __init__(self, records):
+        self.status_code = 200
+        self.text = json.dumps(records)
+        self.content = self.text.encode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        pass
+
+class StringComparingNightscout(object):
+    """/api/v1/treatments.json as Nightscout answers it: created_at is compared as a string."""
+
+    def __init__(self, records):
+        self.records = sorted(records, key=lambda r: r['created_at'], reverse=True)
+        self.requests = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.requests += 1
+        found = [r for r in self.records
+                 if ('find[created_at][$gte]' not in params or r['created_at'] >= params['find[created_at][$gte]'])
+                 and ('find[created_at][$lt]' not in params or r['created_at'] < params['find[created_at][$lt]'])
+                 and ('find[created_at][$lte]' not in params or r['created_at'] <= params['find[created_at][$lte]'])]
+        return Response(found[:params['count']])
+
+@unittest.skipIf(requests is None or not hasattr(time, 'tzset'), 'needs requests and time.tzset')
+class TreatmentsDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'EST+05'
+        time.tzset()
+        self.autotune = load_autotune()
+        self.directory = tempfile.mkdtemp(prefix='oref0-treatments-')
+        os.mkdir(os.path.join(self.directory, 'autotune'))
+        self.autotune.CACHE_DIR = os.path.join(self.directory, 'cache')
+        self.autotune.TREATMENTS_PAGE_SIZE = 7
+        # a treatment every 3 hours from Jan 2 to Jan 15, uploaded with the rig's -05:00 offset
+        self.records = []
+        moment = datetime.datetime(2020, 1, 2)
+        while moment < datetime.datetime(2020, 1, 16):
+            self.records.append({'_id': moment.strftime('%Y%m%d%H'), 'eventType': 'Correction Bolus', 'insulin': 1,
+                                 'created_at': moment.strftime('%Y-%m-%dT%H:%M:%S-05:00')})
+            moment += datetime.timedelta(hours=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def download(self):
+        nightscout = StringComparingNightscout(self.records)
+        self.autotune._nightscout_session = nightscout
+        self.autotune.get_nightscout_carb_and_insulin_treatments(
+            'http://nightscout', datetime.datetime(2020, 1, 5), datetime.datetime(2020, 1, 13), self.directory)
+        with open(os.path.join(self.directory, 'autotune', 'ns-treatments.json')) as f:
+            return (nightscout, json.load(f))
+
+    def expected(self, first, last):
+        # newest first, every treatment of the local days from first to last once
+        return [r['_id'] for r in reversed(self.records) if first <= r['created_at'][:10] <= last]
+
+    def test_offset_treatments_are_filed_by_local_day(self):
+        (nightscout, treatments) = self.download()
+        # Jan 4 (DIA lookback of the first day) to Jan 13, in two windows
+        self.assertEqual([r['_id'] for r in treatments], self.expected('2020-01-04', '2020-01-13'))
+        with gzip.open(self.autotune.NightscoutCache(self.autotune.CACHE_DIR, 'http://nightscout').path(
+                'treatments', datetime.datetime(2020, 1, 12))) as f:
+            day = json.loads(f.read().decode('utf-8'))
+        self.assertEqual([r['_id'] for r in day], self.expected('2020-01-12', '2020-01-12'))
+        # every day is complete and cached, so a second download makes no requests
+        (nightscout, treatments) = self.download()
+        self.assertEqual(nightscout.requests, 0)
+        self.assertEqual([r['_id'] for r in treatments], self.expected('2020-01-04', '2020-01-13'))
+
+if __name__ == '__main__':
+    unittest.main()
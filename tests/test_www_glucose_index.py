@@ -0,0 +1,77 @@
+# Tests of the glucose index of www/app.py:
+# run with python -m pytest tests/ or python -m unittest discover tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+if flask is not None:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www'))
+    import app as www
+
+MINUTE = 60 * 1000
+NOW = 1578800000000
+
+def reading(minutes_ago, sgv):
+    return {'date': NOW - minutes_ago * MINUTE, 'sgv': sgv, 'direction': 'Flat'}
+
+@unittest.skipIf(flask is None, 'needs Flask')
+class GlucoseIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='oref0-www-')
+        self.stamp = time.time()
+        for sub in ('monitor', 'xdrip', 'settings'):
+            os.mkdir(os.path.join(self.directory, sub))
+        self.write('xdrip/glucose.json', [])
+        self.write('settings/profile.json', {'out_units': 'mg/dL'})
+        self.saved = www.myopenaps_dir
+        www.myopenaps_dir = os.path.join(self.directory, '')
+        www.glucose_index = www.GlucoseIndex()
+        self.client = www.app.test_client()
+
+    def tearDown(self):
+        www.myopenaps_dir = self.saved
+        www.glucose_index = www.GlucoseIndex()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        # a new mtime, so the cached document and the index see the rewrite
+        self.stamp += 10
+        os.utime(path, (self.stamp, self.stamp))
+
+    def sgvs(self, url):
+        return [entry['sgv'] for entry in json.loads(self.client.get(url).data)]
+
+    def test_sliding_window_rewrite(self):
+        self.write('monitor/glucose.json', [reading(5, 110), reading(10, 100), reading(15, 90)])
+        self.assertEqual(self.sgvs('/glucose?count=3'), [110, 100, 90])
+        # a new reading at the head and the oldest one dropped
+        self.write('monitor/glucose.json', [reading(0, 120), reading(5, 110), reading(10, 100)])
+        self.assertEqual(self.sgvs('/glucose?count=5'), [120, 110, 100])
+        self.assertEqual(self.sgvs('/sgv.json'), [120, 110, 100])
+
+    def test_revised_reading_is_picked_up(self):
+        self.write('monitor/glucose.json', [reading(5, 100), reading(10, 90)])
+        self.assertEqual(self.sgvs('/sgv.json'), [100, 90])
+        # a backfill that revises the previous head along with the new reading
+        self.write('monitor/glucose.json', [reading(0, 120), reading(5, 999), reading(10, 90)])
+        self.assertEqual(self.sgvs('/glucose'), [120, 999, 90])
+        self.assertEqual(self.sgvs('/glucose?count=2'), [120, 999])
+        self.assertEqual(self.sgvs('/sgv.json'), [120, 999, 90])
+        self.assertEqual(sorted(self.sgvs('/glucose/downsampled?points=3')), [90, 120, 999])
+
+if __name__ == '__main__':
+    unittest.main()
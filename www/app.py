@@ -1,15 +1,612 @@
+import argparse
+import calendar
+import hashlib
+import logging
 import os
+import re
 import socket
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
 
-from flask import Flask, render_template, url_for, json, jsonify, request
+from flask import Flask, Response, g, render_template, url_for, json, jsonify, request
 from flask_cors import CORS
 from datetime import datetime
 import pytz
 
 app = Flask(__name__)
-CORS(app)
-myopenaps_dir = "/root/myopenaps/"
-    
+CORS(app, expose_headers=['Link'])
+myopenaps_dir = os.path.join(os.environ.get('OPENAPS_DIR', "/root/myopenaps"), "")
+
+
+class JsonFileCache(object):
+    """Parsed JSON documents keyed by path.
+
+    An entry is reused as long as the file's (mtime, size, inode) signature is
+    unchanged, so a document is parsed once per rewrite by the loop instead of
+    once per request.  The least recently used entries are evicted once either
+    max_entries or max_bytes (sum of file sizes) is exceeded.
+    Cached documents are shared between requests and must not be mutated.
+    Parse timings and load failures are recorded per path for /metrics.
+    """
+
+    def __init__(self, max_entries=32, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parses = {}  # path -> [count, total seconds, last seconds, last size]
+        self.errors = {}  # (path, exception name) -> count
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def signature(path):
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def load(self, path):
+        try:
+            return self._load(path)
+        except (IOError, OSError, ValueError) as e:
+            # missing or half-written file
+            key = (path, type(e).__name__)
+            with self.lock:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            raise
+
+    def _load(self, path):
+        sig = self.signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == sig:
+                self.entries.pop(path)
+                self.entries[path] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # parse outside the lock so a large file doesn't stall other routes
+        start = time.time()
+        with open(path) as f:
+            data = json.load(f)
+        elapsed = time.time() - start
+        with self.lock:
+            parses = self.parses.setdefault(path, [0, 0.0, 0.0, 0])
+            parses[0] += 1
+            parses[1] += elapsed
+            parses[2] = elapsed
+            parses[3] = sig[1]
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old[0][1]
+            self.entries[path] = (sig, data)
+            self.size += sig[1]
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[0][1]
+                self.evictions += 1
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+json_cache = JsonFileCache(
+    max_entries=int(os.environ.get('OREF0_WWW_CACHE_ENTRIES', 32)),
+    max_bytes=int(os.environ.get('OREF0_WWW_CACHE_BYTES', 16 * 1024 * 1024)))
+
+
+def load_json(filename):
+    return json_cache.load(os.path.join(myopenaps_dir, filename))
+
+
+def glucose_filename():
+    # use whichever CGM source was written most recently
+    if os.path.getmtime(myopenaps_dir + "xdrip/glucose.json") > os.path.getmtime(myopenaps_dir + "monitor/glucose.json"):
+        return "xdrip/glucose.json"
+    return "monitor/glucose.json"
+
+
+ISO_TIMESTAMP = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d+))?)?\s*(Z|[+-]\d\d:?\d\d)?$')
+
+
+def to_epoch_ms(value):
+    # epoch milliseconds from a number or an ISO 8601 timestamp; timestamps
+    # without an offset are taken as UTC.  Raises ValueError if unparseable.
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    m = ISO_TIMESTAMP.match(value.strip())
+    if not m:
+        raise ValueError("invalid timestamp: %r" % value)
+    year, month, day, hour, minute, second, fraction, offset = m.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second or 0)))
+    if offset and offset != 'Z':
+        offset = offset.replace(':', '')
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        seconds -= minutes * 60 if offset[0] == '+' else -minutes * 60
+    return seconds * 1000.0 + (float('0.' + fraction) * 1000.0 if fraction else 0.0)
+
+
+# documents published by the loop, keyed by the topic name used by /stream
+DOCUMENTS = OrderedDict([
+    ('suggested', "enact/suggested.json"),
+    ('enacted', "enact/enacted.json"),
+    ('iob', "monitor/iob.json"),
+    ('meal', "monitor/meal.json"),
+    ('temp_basal', "monitor/temp_basal.json"),
+    ('pump_battery', "monitor/battery.json"),
+    ('edison_battery', "monitor/edison-battery.json"),
+    ('cgm', "monitor/xdripjs/cgm-pill.json"),
+    ('glucose', None),  # resolved by glucose_filename()
+    ('pumphistory', "monitor/pumphistory-24h-zoned.json"),
+    ('profile', "settings/profile.json"),
+    ('temptargets', "settings/temptargets.json"),
+])
+
+
+def document_filename(topic):
+    filename = DOCUMENTS[topic]
+    if filename is None:
+        filename = glucose_filename()
+    return filename
+
+
+def document_signature(topic):
+    path = os.path.join(myopenaps_dir, document_filename(topic))
+    return path, (path,) + json_cache.signature(path)
+
+
+class StreamHub(object):
+    """Fans out changed documents to connected /stream clients.
+
+    A single watcher thread stats the files in DOCUMENTS every poll_interval
+    seconds while at least one client is connected, and when one changes
+    queues the document (serialized once) for every client subscribed to its
+    topic.  A client that falls behind loses its oldest queued events rather
+    than growing without bound.
+    """
+
+    def __init__(self, max_clients=8, poll_interval=0.5, queue_size=16):
+        self.max_clients = max_clients
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.clients = {}
+        self.signatures = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, topics):
+        with self.lock:
+            if len(self.clients) >= self.max_clients:
+                return None
+            q = Queue(maxsize=self.queue_size)
+            self.clients[q] = frozenset(topics)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.watch, name='stream-watcher')
+                self.thread.daemon = True
+                self.thread.start()
+            return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.clients.pop(q, None)
+
+    def read(self, topic):
+        # current document for a newly connected client; changes after this
+        # point are picked up by the watcher
+        path, sig = document_signature(topic)
+        payload = json.dumps(json_cache.load(path))
+        with self.lock:
+            self.signatures.setdefault(topic, sig)
+        return payload
+
+    def publish(self, topic, payload):
+        with self.lock:
+            queues = [q for q, topics in self.clients.items() if topic in topics]
+        for q in queues:
+            try:
+                q.put_nowait((topic, payload))
+            except Full:
+                try:
+                    q.get_nowait()
+                except Empty:
+                    pass
+                try:
+                    q.put_nowait((topic, payload))
+                except Full:
+                    pass
+
+    def watch(self):
+        while True:
+            with self.lock:
+                if not self.clients:
+                    self.thread = None
+                    self.signatures = {}
+                    return
+                wanted = set().union(*self.clients.values())
+            for topic in DOCUMENTS:
+                if topic not in wanted:
+                    with self.lock:
+                        self.signatures.pop(topic, None)
+                    continue
+                try:
+                    path, sig = document_signature(topic)
+                    with self.lock:
+                        last = self.signatures.setdefault(topic, sig)
+                    if last == sig:
+                        continue
+                    payload = json.dumps(json_cache.load(path))
+                except (OSError, IOError, ValueError):
+                    # missing or half-written; try again on the next pass
+                    continue
+                self.signatures[topic] = sig
+                self.publish(topic, payload)
+            time.sleep(self.poll_interval)
+
+
+stream_hub = StreamHub(
+    max_clients=int(os.environ.get('OREF0_WWW_STREAM_CLIENTS', 8)),
+    poll_interval=float(os.environ.get('OREF0_WWW_STREAM_POLL', 0.5)))
+
+
+def glucose_date(entry):
+    try:
+        if 'date' in entry:
+            return float(entry['date'])
+        return to_epoch_ms(entry.get('dateString') or entry['display_time'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class GlucoseIndex(object):
+    """Glucose entries sorted by date, for range queries by binary search.
+
+    The index follows whichever glucose file glucose_filename() picks.  When
+    the loop rewrites that file as a sliding window (new readings at the head,
+    old ones dropped from the tail) the date array is updated in place by
+    trimming and appending and the entries are taken from the new file;
+    anything else, including a switch of CGM source, triggers a full rebuild.
+    """
+
+    def __init__(self):
+        self.source = None
+        self.dates = array('d')
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        path = os.path.join(myopenaps_dir, glucose_filename())
+        source = (path,) + json_cache.signature(path)
+        with self.lock:
+            if source == self.source:
+                return
+            data = json_cache.load(path)
+            if not (self.source and self.source[0] == path and self.update(data)):
+                self.rebuild(data)
+            self.source = source
+
+    def rebuild(self, data):
+        dated = [(glucose_date(entry), entry) for entry in data]
+        dated = sorted((item for item in dated if item[0] is not None), key=lambda item: item[0])
+        self.dates = array('d', [date for date, _ in dated])
+        self.entries = [entry for _, entry in dated]
+
+    def update(self, data):
+        # glucose files are newest first; only the head past our newest
+        # reading and the tail before our oldest are looked at
+        if not data or not self.dates:
+            return False
+        oldest = glucose_date(data[-1])
+        start = bisect_left(self.dates, oldest) if oldest is not None else len(self.dates)
+        if start == len(self.dates) or self.dates[start] != oldest:
+            return False
+        newest = self.dates[-1]
+        head = []
+        for entry in data:
+            date = glucose_date(entry)
+            if date is None or date <= newest:
+                break
+            head.append((date, entry))
+        if len(self.dates) - start + len(head) != len(data):
+            return False
+        # the kept readings may have been revised in place (backfill,
+        # smoothing, a new direction or noise), so only their dates are
+        # reused and the entries come from the new file
+        del self.dates[:start]
+        self.entries = data[len(head):][::-1]
+        for date, entry in reversed(head):
+            self.dates.append(date)
+            self.entries.append(entry)
+        return True
+
+    def series(self, since=None, until=None, count=None):
+        # (source, dates, entries) newer than since and no newer than until,
+        # oldest first
+        self.refresh()
+        with self.lock:
+            lo = 0 if since is None else bisect_right(self.dates, since)
+            hi = len(self.dates) if until is None else bisect_right(self.dates, until)
+            if count is not None:
+                lo = max(lo, hi - count)
+            return self.source, self.dates[lo:hi], self.entries[lo:hi]
+
+    def query(self, since=None, until=None, count=None):
+        # entries newer than since and no newer than until, newest first
+        return self.series(since, until, count)[2][::-1]
+
+
+glucose_index = GlucoseIndex()
+
+
+def glucose_value(entry):
+    value = entry.get('sgv', entry.get('glucose'))
+    return value if isinstance(value, (int, float)) else None
+
+
+def lttb(xs, ys, threshold):
+    """Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indices of at most threshold points that preserve the visual
+    shape of the series: the first and last points are always kept and each
+    bucket in between contributes the point forming the largest triangle with
+    the previously kept point and the average of the next bucket.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    selected = [0]
+    every = float(n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+class DownsampleCache(object):
+    """Downsampled glucose series keyed by (glucose source signature, points,
+    since, until), keeping the most recently used max_entries."""
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, points, since, until):
+        source, dates, entries = glucose_index.series(since, until)
+        key = (source, points, since, until)
+        with self.lock:
+            if key in self.entries:
+                result = self.entries.pop(key)
+                self.entries[key] = result
+                return result
+        valued = [(date, glucose_value(entry), entry) for date, entry in zip(dates, entries)]
+        valued = [item for item in valued if item[1] is not None]
+        xs = [date for date, _, _ in valued]
+        ys = [float(value) for _, value, _ in valued]
+        result = [valued[i][2] for i in reversed(lttb(xs, ys, points))]
+        with self.lock:
+            self.entries[key] = result
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+
+downsample_cache = DownsampleCache()
+
+
+def time_range_args():
+    # since/until (epoch ms or ISO 8601) and count query parameters
+    since = request.args.get('since')
+    until = request.args.get('until')
+    return (None if since is None else to_epoch_ms(since),
+            None if until is None else to_epoch_ms(until),
+            request.args.get('count', type=int))
+
+
+class RecordTimes(object):
+    """Epoch milliseconds of each record's timestamp field, recomputed only
+    when the underlying file changes."""
+
+    def __init__(self, field):
+        self.field = field
+        self.source = None
+        self.times = []
+        self.lock = threading.Lock()
+
+    def get(self, path, data):
+        source = (path,) + json_cache.signature(path)
+        with self.lock:
+            if source != self.source:
+                self.times = []
+                for record in data:
+                    try:
+                        self.times.append(to_epoch_ms(record[self.field]))
+                    except (KeyError, TypeError, ValueError, AttributeError):
+                        self.times.append(None)
+                self.source = source
+            return self.times
+
+
+pumphistory_times = RecordTimes('timestamp')
+
+
+def json_array(records, batch=64):
+    # serialize a list incrementally for a streamed response
+    yield '['
+    for i in range(0, len(records), batch):
+        chunk = ','.join(json.dumps(record) for record in records[i:i + batch])
+        yield chunk if i == 0 else ',' + chunk
+    yield ']'
+
+
+def prometheus_labels(**labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in sorted(labels.items()))
+
+
+class Metrics(object):
+    """Request counters and latency histograms in Prometheus text format.
+
+    Observing a request is a dict update and a bisect under one lock, so it
+    is cheap enough to leave on for every route.  Latency of streamed
+    responses is measured up to the point the response is handed to the
+    server, not until the stream ends.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.requests = {}  # (route, method, status) -> count
+        self.latency = {}  # route -> [count per bucket..., +Inf count, sum]
+        self.exceptions = {}  # exception name -> count
+        self.lock = threading.Lock()
+
+    def observe(self, route, method, status, seconds, exc=None):
+        bucket = bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get(route)
+            if histogram is None:
+                histogram = self.latency[route] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+            if exc is not None:
+                name = type(exc).__name__
+                self.exceptions[name] = self.exceptions.get(name, 0) + 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP oref0_http_requests_total Requests by route, method and status.')
+            lines.append('# TYPE oref0_http_requests_total counter')
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append('oref0_http_requests_total{%s} %d' % (
+                    prometheus_labels(route=route, method=method, status=status), count))
+            lines.append('# HELP oref0_http_request_duration_seconds Time to produce a response by route.')
+            lines.append('# TYPE oref0_http_request_duration_seconds histogram')
+            for route, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for le, count in zip(self.BUCKETS + ('+Inf',), histogram[:-1]):
+                    cumulative += count
+                    lines.append('oref0_http_request_duration_seconds_bucket{%s} %d' % (
+                        prometheus_labels(route=route, le=le), cumulative))
+                lines.append('oref0_http_request_duration_seconds_sum{%s} %f' % (
+                    prometheus_labels(route=route), histogram[-1]))
+                lines.append('oref0_http_request_duration_seconds_count{%s} %d' % (
+                    prometheus_labels(route=route), cumulative))
+            lines.append('# HELP oref0_http_exceptions_total Unhandled exceptions in routes by type.')
+            lines.append('# TYPE oref0_http_exceptions_total counter')
+            for name, count in sorted(self.exceptions.items()):
+                lines.append('oref0_http_exceptions_total{%s} %d' % (prometheus_labels(exception=name), count))
+
+        with json_cache.lock:
+            parses = sorted(json_cache.parses.items())
+            errors = sorted(json_cache.errors.items())
+            hits, misses = json_cache.hits, json_cache.misses
+        lines.append('# HELP oref0_json_cache_requests_total JSON cache lookups by result.')
+        lines.append('# TYPE oref0_json_cache_requests_total counter')
+        lines.append('oref0_json_cache_requests_total{result="hit"} %d' % hits)
+        lines.append('oref0_json_cache_requests_total{result="miss"} %d' % misses)
+        lines.append('# HELP oref0_json_parses_total JSON files parsed.')
+        lines.append('# TYPE oref0_json_parses_total counter')
+        for path, (count, _, _, _) in parses:
+            lines.append('oref0_json_parses_total{%s} %d' % (prometheus_labels(file=path), count))
+        lines.append('# HELP oref0_json_parse_seconds_total Time spent parsing JSON files.')
+        lines.append('# TYPE oref0_json_parse_seconds_total counter')
+        for path, (_, total, _, _) in parses:
+            lines.append('oref0_json_parse_seconds_total{%s} %f' % (prometheus_labels(file=path), total))
+        lines.append('# HELP oref0_json_last_parse_seconds Time the most recent parse of a JSON file took.')
+        lines.append('# TYPE oref0_json_last_parse_seconds gauge')
+        for path, (_, _, last, _) in parses:
+            lines.append('oref0_json_last_parse_seconds{%s} %f' % (prometheus_labels(file=path), last))
+        lines.append('# HELP oref0_json_file_size_bytes Size of a JSON file when it was last parsed.')
+        lines.append('# TYPE oref0_json_file_size_bytes gauge')
+        for path, (_, _, _, size) in parses:
+            lines.append('oref0_json_file_size_bytes{%s} %d' % (prometheus_labels(file=path), size))
+        lines.append('# HELP oref0_json_load_errors_total JSON files that were missing (IOError/OSError) '
+                     'or half-written (ValueError) when loaded.')
+        lines.append('# TYPE oref0_json_load_errors_total counter')
+        for (path, name), count in errors:
+            lines.append('oref0_json_load_errors_total{%s} %d' % (prometheus_labels(file=path, exception=name), count))
+
+        lines.append('# HELP oref0_file_age_seconds Seconds since the loop last wrote a file.')
+        lines.append('# TYPE oref0_file_age_seconds gauge')
+        now = time.time()
+        for name, path in loop_freshness_files():
+            try:
+                age = now - os.path.getmtime(path)
+            except (IOError, OSError):
+                continue
+            lines.append('oref0_file_age_seconds{%s} %f' % (prometheus_labels(file=name), age))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def loop_freshness_files():
+    files = [('pump_loop_success', "/tmp/pump_loop_success"),
+             ('suggested.json', os.path.join(myopenaps_dir, DOCUMENTS['suggested']))]
+    try:
+        files.append(('glucose.json', os.path.join(myopenaps_dir, glucose_filename())))
+    except (IOError, OSError):
+        pass
+    return files
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+@app.after_request
+def record_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request(exc):
+    start = g.get('request_start')
+    if start is None:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe(route, request.method, g.get('response_status', 500), time.time() - start, exc)
+
+
 def getip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -24,10 +621,6 @@ def getip():
 
 @app.route("/")
 def index():
-    try:
-      myopenaps_dir = os.environ['OPENAPS_DIR']
-    except KeyError:
-        myopenaps_dir = "/root/myopenaps/"
     data=dict()
     try:
         error_text = "getHost"
@@ -47,52 +640,64 @@ def index():
 
 @app.route("/suggested")
 def suggested():
-    json_url = os.path.join(myopenaps_dir + "enact/suggested.json")
-    data = json.load(open(json_url))
+    data = load_json("enact/suggested.json")
     return jsonify(data)
 
 @app.route("/enacted")
 def enacted():
-    json_url = os.path.join(myopenaps_dir + "enact/enacted.json")
-    data = json.load(open(json_url))
+    data = load_json("enact/enacted.json")
     return jsonify(data)
 
 @app.route("/glucose")
 def glucose():
-    if os.path.getmtime(myopenaps_dir + "xdrip/glucose.json") > os.path.getmtime(myopenaps_dir + "monitor/glucose.json"):
-        json_url = os.path.join(myopenaps_dir + "xdrip/glucose.json")
+    try:
+        since, until, count = time_range_args()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if since is None and until is None and count is None:
+        data = load_json(glucose_filename())
     else:
-        json_url = os.path.join(myopenaps_dir + "monitor/glucose.json")
-    data = json.load(open(json_url))
+        data = glucose_index.query(since, until, count)
+    return jsonify(data)
+
+@app.route("/glucose/downsampled")
+def glucose_downsampled():
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    points = request.args.get('points', default=288, type=int)
+    if points < 3:
+        return jsonify(error="points must be at least 3"), 400
+    data = downsample_cache.get(points, since, until)
     return jsonify(data)
 
 @app.route("/sgv.json")
 def sgvjson():
-    json_url = os.path.join(myopenaps_dir + "settings/profile.json")
-    data = json.load(open(json_url))
-    units = data['out_units']
-    count = request.args.get('count', default = 10, type = int)
-    if os.path.getmtime(myopenaps_dir + "xdrip/glucose.json") > os.path.getmtime(myopenaps_dir + "monitor/glucose.json"):
-        json_url = os.path.join(myopenaps_dir + "xdrip/glucose.json")
-    else:
-        json_url = os.path.join(myopenaps_dir + "monitor/glucose.json")
-    data = json.load(open(json_url))
+    units = load_json("settings/profile.json")['out_units']
+    try:
+        since, until, count = time_range_args()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    data = glucose_index.query(since, until, 10 if count is None else count)
+    if not data:
+        return jsonify(data)
+    # the entries are shared through the cache, so annotate a copy
+    data[0] = dict(data[0])
     if units == "mg/dL":
         data[0]['units_hint'] = "mgdl"
     else:
         data[0]['units_hint'] = "mmol"
-    return jsonify(data[0:count])
+    return jsonify(data)
 
 @app.route("/temptargets")
 def temptargets():
-    json_url = os.path.join(myopenaps_dir + "settings/temptargets.json")
-    data = json.load(open(json_url))
+    data = load_json("settings/temptargets.json")
     return jsonify(data)
 
 @app.route("/cgm")
 def cgm():
-    json_url = os.path.join(myopenaps_dir + "monitor/xdripjs/cgm-pill.json")
-    data = json.load(open(json_url))
+    data = load_json("monitor/xdripjs/cgm-pill.json")
     return jsonify(data)
 
 @app.route("/system")
@@ -105,45 +710,247 @@ def system():
 
 @app.route("/profile")
 def profile():
-    json_url = os.path.join(myopenaps_dir + "settings/profile.json")
-    data = json.load(open(json_url))
+    data = load_json("settings/profile.json")
     return jsonify(data)
 
 @app.route("/pumphistory")
 def pumphistory():
-    json_url = os.path.join(myopenaps_dir + "monitor/pumphistory-24h-zoned.json")
-    data = json.load(open(json_url))
-    return jsonify(data)
+    # pump history is newest first; pages walk backwards in time and the
+    # cursor is the timestamp of the last record returned plus how many
+    # records with that timestamp have been returned so far
+    path = os.path.join(myopenaps_dir, "monitor/pumphistory-24h-zoned.json")
+    data = json_cache.load(path)
+    try:
+        since, until, _ = time_range_args()
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            cursor_time, cursor_seen = cursor.split(':')
+            cursor_time, cursor_seen = float(cursor_time), int(cursor_seen)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    types = request.args.get('_type')
+    types = set(types.split(',')) if types else None
+    limit = request.args.get('limit', type=int)
+
+    if since is None and until is None and cursor is None and types is None and limit is None:
+        return Response(json_array(data), mimetype='application/json')
+
+    times = pumphistory_times.get(path, data)
+    timed = since is not None or until is not None or cursor is not None
+    skip = cursor_seen if cursor is not None else 0
+    selected = []
+    last_time = None
+    last_seen = 0
+    for record, t in zip(data, times):
+        if t is None and timed:
+            continue
+        if since is not None and t <= since:
+            break
+        if until is not None and t > until:
+            continue
+        if types is not None and record.get('_type') not in types:
+            continue
+        if cursor is not None:
+            if t > cursor_time:
+                continue
+            if t == cursor_time and skip > 0:
+                skip -= 1
+                continue
+        if limit is not None and len(selected) >= limit:
+            break
+        selected.append(record)
+        if t == last_time:
+            last_seen += 1
+        else:
+            last_time, last_seen = t, 1
+
+    response = Response(json_array(selected), mimetype='application/json')
+    if limit is not None and len(selected) == limit and last_time is not None:
+        if cursor is not None and last_time == cursor_time:
+            last_seen += cursor_seen
+        args = request.args.to_dict()
+        args['cursor'] = '%d:%d' % (last_time, last_seen)
+        response.headers['Link'] = '<%s>; rel="next"' % url_for('pumphistory', **args)
+    return response
 
 @app.route("/iob")
 def iob():
-    json_url = os.path.join(myopenaps_dir + "monitor/iob.json")
-    data = json.load(open(json_url))
+    data = load_json("monitor/iob.json")
     return jsonify(data)
 
 @app.route("/pump_battery")
 def pump_battery():
-    json_url = os.path.join(myopenaps_dir + "monitor/battery.json")
-    data = json.load(open(json_url))
+    data = load_json("monitor/battery.json")
     return jsonify(data)
     
 @app.route("/edison_battery")
 def edison_battery():
-    json_url = os.path.join(myopenaps_dir + "monitor/edison-battery.json")
-    data = json.load(open(json_url))
+    data = load_json("monitor/edison-battery.json")
     return jsonify(data)
 
 @app.route("/meal")
 def meal():
-    json_url = os.path.join(myopenaps_dir + "monitor/meal.json")
-    data = json.load(open(json_url))
+    data = load_json("monitor/meal.json")
     return jsonify(data)
 
 @app.route("/temp_basal")
 def temp_basal():
-    json_url = os.path.join(myopenaps_dir + "monitor/temp_basal.json")
-    data = json.load(open(json_url))
+    data = load_json("monitor/temp_basal.json")
     return jsonify(data)
 
+@app.route("/cache")
+def cache():
+    return jsonify(json_cache.stats())
+
+# what a dashboard screen needs, returned by /snapshot unless fields= is given
+SNAPSHOT_FIELDS = ['suggested', 'enacted', 'iob', 'meal', 'temp_basal',
+                   'pump_battery', 'edison_battery', 'cgm', 'glucose']
+
+@app.route("/snapshot")
+def snapshot():
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else SNAPSHOT_FIELDS
+    unknown = [field for field in fields if field not in DOCUMENTS]
+    if unknown:
+        return jsonify(error="unknown fields: " + ",".join(unknown), fields=list(DOCUMENTS)), 400
+
+    # the ETag only depends on the files' signatures, so an unchanged
+    # snapshot is answered without loading anything
+    paths = {}
+    tag = hashlib.sha1()
+    for field in fields:
+        try:
+            paths[field], sig = document_signature(field)
+        except (OSError, IOError):
+            sig = None
+        tag.update(repr((field, sig)).encode('utf-8'))
+    etag = tag.hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        data = {}
+        for field in fields:
+            try:
+                data[field] = json_cache.load(paths[field])
+            except (KeyError, OSError, IOError, ValueError):
+                # missing or half-written file
+                data[field] = None
+        response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/stream")
+def stream():
+    topics = request.args.get('topics')
+    topics = topics.split(',') if topics else list(DOCUMENTS)
+    unknown = [topic for topic in topics if topic not in DOCUMENTS]
+    if unknown:
+        return jsonify(error="unknown topics: " + ",".join(unknown), topics=list(DOCUMENTS)), 400
+    q = stream_hub.subscribe(topics)
+    if q is None:
+        return jsonify(error="too many stream clients"), 503, {'Retry-After': '30'}
+
+    def events():
+        try:
+            # start each client off with the current state of its topics
+            for topic in topics:
+                try:
+                    payload = stream_hub.read(topic)
+                except (OSError, IOError, ValueError):
+                    continue
+                yield "event: %s\ndata: %s\n\n" % (topic, payload)
+            while True:
+                try:
+                    topic, payload = q.get(timeout=15)
+                except Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "event: %s\ndata: %s\n\n" % (topic, payload)
+        finally:
+            stream_hub.unsubscribe(q)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(events(), mimetype='text/event-stream', headers=headers)
+
+def gzip_stream(chunks, level):
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+@app.after_request
+def gzip_response(response):
+    # only enabled in production mode, see serve_production()
+    min_size = app.config.get('GZIP_MIN_SIZE')
+    if (min_size is None or response.status_code != 200
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    level = app.config.get('GZIP_LEVEL', 6)
+    if response.is_streamed:
+        # size is unknown up front; streamed routes are the large ones
+        response.response = gzip_stream(response.response, level)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        response.set_data(z.compress(data) + z.flush())
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def serve_production(host, port, threads, timeout, gzip_min_size):
+    app.config['GZIP_MIN_SIZE'] = gzip_min_size
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    if serve is not None:
+        logging.info("Serving on %s:%d with waitress, %d threads", host, port, threads)
+        # channel_timeout closes idle keep-alive connections and stalled requests
+        serve(app, host=host, port=port, threads=threads, channel_timeout=timeout,
+              connection_limit=max(100, threads * 4), ident='oref0')
+    else:
+        from werkzeug.serving import run_simple, WSGIRequestHandler
+
+        class KeepAliveRequestHandler(WSGIRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+        KeepAliveRequestHandler.timeout = timeout
+        logging.warning("waitress is not installed (sudo pip install waitress); "
+                        "falling back to the threaded Werkzeug server, one thread per connection")
+        run_simple(host, port, app, threaded=True, request_handler=KeepAliveRequestHandler)
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    parser = argparse.ArgumentParser(description='oref0 web dashboard')
+    parser.add_argument('--production', action='store_true',
+                        default=os.environ.get('OREF0_WWW_MODE') == 'production',
+                        help='serve with a threaded WSGI server instead of the debug server (OREF0_WWW_MODE=production)')
+    parser.add_argument('--host', default=os.environ.get('OREF0_WWW_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('OREF0_WWW_PORT', 5000)))
+    # each /stream client holds a thread for as long as it stays connected
+    parser.add_argument('--threads', type=int,
+                        default=int(os.environ.get('OREF0_WWW_THREADS', stream_hub.max_clients + 4)),
+                        help='worker threads in production mode (OREF0_WWW_THREADS)')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('OREF0_WWW_TIMEOUT', 30)),
+                        help='seconds before an idle or stalled connection is closed (OREF0_WWW_TIMEOUT)')
+    parser.add_argument('--gzip-min-size', type=int, default=int(os.environ.get('OREF0_WWW_GZIP_MIN_SIZE', 1024)),
+                        help='gzip JSON responses of at least this many bytes (OREF0_WWW_GZIP_MIN_SIZE)')
+    args = parser.parse_args()
+
+    if args.production:
+        logging.basicConfig(level=logging.INFO)
+        serve_production(args.host, args.port, args.threads, args.timeout, args.gzip_min_size)
+    else:
+        app.run(debug=True, host=args.host, port=args.port)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Load test for the oref0 web dashboard (www/app.py).
+#
+# Runs a fixed number of client threads against a running server, each on a
+# keep-alive connection, cycling through the given paths for a fixed time, then
+# reports requests/sec and latency percentiles per path.  Run it on the rig
+# against both modes, e.g.
+#
+#   python app.py --port 5000 &                 # debug server (default)
+#   python benchmark.py --url http://localhost:5000
+#   python app.py --production --port 5001 &    # production mode
+#   python benchmark.py --url http://localhost:5001
+
+from __future__ import print_function
+import argparse
+import threading
+import time
+try:
+    import http.client as httplib
+    from urllib.parse import urlsplit
+except ImportError:
+    import httplib
+    from urlparse import urlsplit
+
+DEFAULT_PATHS = '/suggested,/enacted,/iob,/meal,/glucose,/sgv.json,/pumphistory,/snapshot'
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def client(url, paths, deadline, gzip, results, errors):
+    parts = urlsplit(url)
+    conn = None
+    headers = {'Accept-Encoding': 'gzip'} if gzip else {}
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.time()
+        try:
+            if conn is None:
+                conn = httplib.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors[path] = errors.get(path, 0) + 1
+                continue
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                conn = None
+        except Exception:
+            errors[path] = errors.get(path, 0) + 1
+            if conn is not None:
+                conn.close()
+            conn = None
+            continue
+        results.setdefault(path, []).append(time.time() - start)
+    if conn is not None:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the oref0 web dashboard')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--paths', default=DEFAULT_PATHS, help='comma separated, default %s' % DEFAULT_PATHS)
+    parser.add_argument('--concurrency', '-c', type=int, default=4)
+    parser.add_argument('--duration', '-t', type=float, default=10, help='seconds')
+    parser.add_argument('--gzip', action='store_true', help='send Accept-Encoding: gzip')
+    args = parser.parse_args()
+
+    paths = args.paths.split(',')
+    deadline = time.time() + args.duration
+    results = [{} for _ in range(args.concurrency)]
+    errors = [{} for _ in range(args.concurrency)]
+    threads = [threading.Thread(target=client, args=(args.url, paths, deadline, args.gzip, results[n], errors[n]))
+               for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print("%-16s %8s %8s %8s %8s %8s" % ('path', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    total = []
+    total_errors = 0
+    for path in paths + ['total']:
+        if path == 'total':
+            latencies = total
+            failed = total_errors
+        else:
+            latencies = [x for r in results for x in r.get(path, [])]
+            failed = sum(e.get(path, 0) for e in errors)
+            total.extend(latencies)
+            total_errors += failed
+        latencies.sort()
+        print("%-16s %8d %8.1f %8.1f %8.1f %8d" % (
+            path, len(latencies), len(latencies) / args.duration,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, failed))
+
+
+if __name__ == '__main__':
+    main()